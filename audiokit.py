@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import numpy
+
+from context import JobContext
+from runner import CommandRunner
+
+class AudioAssembler:
+
+    # The same as the silence between videos, so all audio can be concatenated
+    SAMPLE_RATE = 22050
+    CHANNELS = 1
+
+    workers = 8
+
+    def __init__(self, sampleRate=SAMPLE_RATE, channels=CHANNELS):
+
+        self.sampleRate = sampleRate
+        self.channels = channels
+
+        self.chunks = list()
+        self.sampleCount = 0
+
+    def decode(self, pathname):
+
+        # Decode to signed 16-bit PCM at the assembler's rate and layout
+        cmd = ['ffmpeg', '-v', 'quiet', '-i', pathname, '-f', 's16le', '-acodec', 'pcm_s16le',
+                '-ar', str(self.sampleRate), '-ac', str(self.channels), '-']
+
+        result = CommandRunner.run(cmd, captureStdout=True)
+
+        return numpy.frombuffer(result.stdout, dtype='<i2').reshape(-1, self.channels)
+
+    def decodeMany(self, pathnames):
+
+        if len(pathnames) < 2:
+            return [self.decode(pathname) for pathname in pathnames]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=AudioAssembler.workers) as executor:
+            return list(executor.map(JobContext.wrap(self.decode), pathnames))
+
+    def getLength(self):
+        return float(self.sampleCount) / self.sampleRate
+
+    def appendSamples(self, samples):
+
+        start = self.getLength()
+
+        self.chunks.append(samples)
+        self.sampleCount += len(samples)
+
+        return start, self.getLength()
+
+    def appendSilence(self, seconds):
+
+        samples = numpy.zeros((int(round(seconds * self.sampleRate)), self.channels), dtype='<i2')
+        return self.appendSamples(samples)
+
+    def encode(self, dstPath, bitrate='64k'):
+
+        if 0 == len(self.chunks):
+            return None
+
+        print('Encode', self.getLength(), 'seconds of audio to', dstPath)
+
+        samples = numpy.concatenate(self.chunks)
+
+        # Only one AAC encode for all segments
+        cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 's16le', '-ar', str(self.sampleRate),
+                '-ac', str(self.channels), '-i', '-', '-vn', '-acodec', 'aac', '-b:a', bitrate, dstPath]
+
+        CommandRunner.run(cmd, input=samples.tobytes())
+
+        return dstPath
+
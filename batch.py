@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+
+from combiner import Combiner
+from datetime import datetime
+from imgkit import ImageKit
+from network import Network
+from runner import CommandRunner
+from tracer import Tracer
+from tts import Tts
+from utils import OutputPath
+
+class BatchResult:
+
+    def __init__(self, contentFile, videoFile):
+
+        self.contentFile = contentFile
+        self.videoFile = videoFile
+
+        self.status = 'pending'
+        self.error = None
+        self.seconds = 0.0
+
+    def toDict(self):
+        return {'content': self.contentFile, 'video': self.videoFile, 'status': self.status,
+                'error': self.error, 'seconds': round(self.seconds, 2)}
+
+def getVideoFile(outputPath, contentFile, names):
+
+    name = os.path.splitext(os.path.basename(contentFile))[0]
+
+    # Content files with the same name in different directories get their own videos
+    count = names.get(name, 0)
+    names[name] = count + 1
+
+    if count > 0:
+        name = '{}-{}'.format(name, count)
+
+    return os.path.join(outputPath, '{}.mp4'.format(name))
+
+def renderOne(combiner, tts, result, jobs, cpus):
+
+    startTime = time.time()
+
+    print('Now: ', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    print('Render', result.contentFile, 'to', result.videoFile)
+
+    # One content file failing doesn't stop the others
+    try:
+        with Tracer.span('job', 'job', content=result.contentFile, jobs=jobs):
+            combiner.combine(tts, result.contentFile, result.videoFile, jobs, cpus)
+
+        if combiner.videoPath is None:
+            result.status = 'failed'
+            result.error = 'No video is rendered'
+        else:
+            result.status = 'done'
+
+    except KeyboardInterrupt:
+        raise
+    except Exception as e:
+        print('Error occurs at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        traceback.print_exc(file=sys.stdout)
+
+        result.status = 'failed'
+        result.error = str(e) or type(e).__name__
+
+    result.seconds = time.time() - startTime
+
+def run(name, configFile, ttsConfigFile, contentFiles, outputPath, jobs=1, withLogo=True, cpus=None,
+        tracePath=None, profileName=None, reportPath=None):
+
+    OutputPath.init(configFile)
+
+    Tracer.init(tracePath, profilePrefix=tracePath or os.path.join(OutputPath.LOG_OUTPUT_PATH, name))
+
+    # Network, tts and prepared assets are shared, so their caches stay warm for all content files
+    Network.init(configFile)
+    CommandRunner.init(configFile)
+    ImageKit.init(configFile, cpus)
+    Network.setIsEnabled(True)
+
+    tts = Tts(ttsConfigFile)
+    combiner = Combiner(configFile, withLogo, profileName)
+
+    names = dict()
+    results = [BatchResult(contentFile, getVideoFile(outputPath, contentFile, names))
+            for contentFile in contentFiles]
+
+    startTime = time.time()
+
+    try:
+        for result in results:
+            renderOne(combiner, tts, result, jobs, cpus)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Tracer.save()
+
+    print('Rendered {} of {} content files in {:.2f} seconds'.format(
+        len([result for result in results if 'done' == result.status]), len(results), time.time() - startTime))
+
+    for result in results:
+        print('{:>7} {:8.2f}s {} {}'.format(result.status, result.seconds, result.contentFile,
+            result.error or result.videoFile))
+
+    if reportPath:
+        with open(reportPath, 'w') as fp:
+            fp.write(json.dumps([result.toDict() for result in results], ensure_ascii=False, indent=4))
+
+        print('Results are saved to', reportPath)
+
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('configFile', metavar='config-file')
+    parser.add_argument('ttsConfigFile', metavar='tts-config-file')
+    parser.add_argument('contentFiles', metavar='content-file', nargs='+')
+    parser.add_argument('-o', '--output', dest='outputPath', required=True, metavar='DIR',
+            help='directory of videos, one named after each content file')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of tasks run in parallel for a content file, 1 for a serial run')
+    parser.add_argument('--cpus', type=int, default=None,
+            help='number of cores shared by encoders, all cores by default')
+    parser.add_argument('--no-logo', dest='withLogo', action='store_false',
+            help='don\'t add logo to videos')
+    parser.add_argument('--profile', dest='profileName', choices=['draft', 'preview', 'final'],
+            help='encoder profile, overrides the ones in content files, final by default')
+    parser.add_argument('--trace', dest='tracePath', metavar='TRACE-FILE',
+            help='save spans of all jobs as Chrome trace events')
+    parser.add_argument('--report', dest='reportPath', metavar='REPORT-FILE',
+            help='save the result of every content file as json')
+
+    args = parser.parse_args()
+
+    os.environ['TZ'] = 'Asia/Shanghai'
+    time.tzset()
+
+    name = os.path.basename(sys.argv[0])[:-3] # Remove ".py"
+    configFile = os.path.realpath(args.configFile)
+    ttsConfigFile = os.path.realpath(args.ttsConfigFile)
+    contentFiles = [os.path.realpath(contentFile) for contentFile in args.contentFiles]
+
+    outputPath = os.path.realpath(args.outputPath)
+    os.makedirs(outputPath, exist_ok=True)
+
+    tracePath = os.path.realpath(args.tracePath) if args.tracePath else None
+    reportPath = os.path.realpath(args.reportPath) if args.reportPath else None
+
+    results = run(name, configFile, ttsConfigFile, contentFiles, outputPath, max(1, args.jobs),
+            args.withLogo, args.cpus, tracePath, args.profileName, reportPath)
+
+    # Non-zero when any content file fails
+    sys.exit(0 if all('done' == result.status for result in results) else 1)
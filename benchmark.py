@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import argparse
+import http.server
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+# Synthetic contents, from a single short story up to 50 stories with 20 images each
+SIZES = {
+    'tiny': {'stories': 1, 'images': 2, 'paragraphs': 3},
+    'small': {'stories': 3, 'images': 5, 'paragraphs': 5},
+    'medium': {'stories': 10, 'images': 10, 'paragraphs': 8},
+    'large': {'stories': 50, 'images': 20, 'paragraphs': 10},
+}
+
+WORDS = ['once', 'upon', 'a', 'time', 'there', 'were', 'three', 'little', 'pigs', 'wolf', 'house',
+        'straw', 'sticks', 'bricks', 'huff', 'puff', 'blow', 'down', 'forest', 'king', 'queen',
+        'princess', 'castle', 'garden', 'golden', 'apple', 'river', 'bridge', 'troll', 'goat',
+        'happily', 'ever', 'after', 'the', 'and', 'with', 'into', 'over', 'under', 'very']
+
+IMAGE_COUNT = 20 # Distinct images, reused by all stories
+CHARACTERS_PER_SECOND = 15 # Speech rate of the TTS stand-in
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    # Serves images from the asset path and speech like the TTS service
+    assetPath = None
+    latency = 0.0
+
+    _ttsMutex = threading.Lock()
+    _ttsPaths = dict()
+
+    def do_GET(self):
+
+        if StandInHandler.latency > 0:
+            time.sleep(StandInHandler.latency)
+
+        url = urllib.parse.urlparse(self.path)
+
+        if url.path.startswith('/tts/'):
+            self.sendTts(urllib.parse.parse_qs(url.query))
+        else:
+            self.sendFile(os.path.join(StandInHandler.assetPath, os.path.basename(url.path)))
+
+    def sendTts(self, params):
+
+        # The preparation request only has to succeed
+        if 'cache_flag' not in params:
+            self.sendData(b'OK', 'text/plain')
+            return
+
+        text = params.get('TXT', [''])[0]
+        duration = max(1.0, round(2.0 * len(text) / CHARACTERS_PER_SECOND) / 2.0)
+
+        with StandInHandler._ttsMutex:
+
+            pathname = StandInHandler._ttsPaths.get(duration)
+
+            if pathname is None:
+
+                pathname = os.path.join(StandInHandler.assetPath, 'tts-{:.1f}.mp3'.format(duration))
+
+                subprocess.run(['ffmpeg', '-y', '-v', 'error', '-f', 'lavfi',
+                    '-i', 'sine=frequency=440:sample_rate=22050:duration={}'.format(duration),
+                    '-ac', '1', '-acodec', 'libmp3lame', pathname], check=True)
+
+                StandInHandler._ttsPaths[duration] = pathname
+
+        with open(pathname, 'rb') as fp:
+            self.sendData(fp.read(), 'audio/mpeg')
+
+    def sendFile(self, pathname):
+
+        contentTypes = {'.jpg': 'image/jpeg', '.png': 'image/png', '.gif': 'image/gif'}
+
+        try:
+            with open(pathname, 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            self.send_error(404)
+            return
+
+        self.sendData(data, contentTypes.get(os.path.splitext(pathname)[1], 'application/octet-stream'))
+
+    def sendData(self, data, contentType):
+
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def createImages(assetPath):
+
+    import numpy
+    from PIL import Image
+
+    print('Create', IMAGE_COUNT, 'images in', assetPath)
+
+    # Smooth patterns with some noise, in landscape, portrait and wide sizes
+    sizes = [(1600, 1200), (1200, 1600), (1920, 1080)]
+
+    for index in range(IMAGE_COUNT):
+
+        width, height = sizes[index % len(sizes)]
+        rand = numpy.random.RandomState(index)
+
+        y, x = numpy.mgrid[0:height, 0:width].astype(numpy.float32)
+        pixels = numpy.empty((height, width, 3), dtype=numpy.float32)
+
+        for channel in range(3):
+            fx, fy, phase = rand.uniform(0.002, 0.02, 2).tolist() + [rand.uniform(0, math.pi)]
+            pixels[:, :, channel] = 127.5 + 100.0 * numpy.sin(x * fx + y * fy + phase)
+
+        pixels += rand.normal(0, 8, pixels.shape)
+        image = Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8))
+
+        # Some images need to be translated to jpg
+        if 3 == index % 7:
+            image.save(os.path.join(assetPath, '{}.png'.format(index)))
+        else:
+            image.save(os.path.join(assetPath, '{}.jpg'.format(index)), quality=85)
+
+    Image.new('RGB', (1280, 720), (64, 96, 160)).save(os.path.join(assetPath, 'background.jpg'), quality=90)
+    Image.new('RGB', (240, 80), (240, 200, 40)).save(os.path.join(assetPath, 'logo.png'))
+
+def createText(rand, paragraphs):
+
+    texts = list()
+
+    for index in range(paragraphs):
+
+        words = [rand.choice(WORDS) for i in range(rand.randint(15, 35))]
+        texts.append('{}.'.format(' '.join(words).capitalize()))
+
+    return '{}\n'.format('\n\n'.join(texts))
+
+def createContent(size, baseUrl):
+
+    rand = random.Random(size)
+    params = SIZES[size]
+
+    images = list()
+
+    for index in range(IMAGE_COUNT):
+        suffix = 'png' if 3 == index % 7 else 'jpg'
+        images.append('{}images/{}.{}'.format(baseUrl, index, suffix))
+
+    contents = list()
+
+    for story in range(params['stories']):
+
+        # Different stories have different urls even for the same images
+        urls = ['{}?story={}'.format(images[(story + index) % IMAGE_COUNT], story)
+                for index in range(params['images'])]
+
+        contents.append({'name': 'Story {}'.format(story + 1), 'image-urls-list': urls,
+            'text': createText(rand, params['paragraphs'])})
+
+    return {'coding': 'plate', 'language': 'english',
+            'logo': '{}images/logo.png'.format(baseUrl), 'background': '{}images/background.jpg'.format(baseUrl),
+            'font': '', 'width': '1280', 'height': '720', 'logo-width': '120', 'logo-height': '40',
+            'contents-list': contents}
+
+def createCase(workPath, size, baseUrl, font, jobs, cpus, engine, profile, imageWorkers=None, motion=None):
+
+    casePath = os.path.join(workPath, size)
+
+    # Every case starts with empty outputs and caches
+    shutil.rmtree(casePath, ignore_errors=True)
+    os.makedirs(casePath)
+
+    configFile = os.path.join(casePath, 'config.ini')
+
+    with open(configFile, 'w') as fp:
+        fp.write('output-path={}\n'.format(os.path.join(casePath, 'output')))
+        fp.write('cache-path={}\n'.format(os.path.join(casePath, 'caches')))
+        fp.write('font-path={}\n'.format(font or ''))
+
+        if imageWorkers is not None:
+            fp.write('image-workers={}\n'.format(imageWorkers))
+
+    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'templates', 'tts.json')) as fp:
+        ttsConfig = json.loads(fp.read())
+
+    # The oddcast engine talks to the local stand-in
+    ttsConfig['engine'] = engine
+    ttsConfig['url'] = '{}tts/gen.php?'.format(baseUrl)
+
+    ttsConfigFile = os.path.join(casePath, 'tts.json')
+
+    with open(ttsConfigFile, 'w') as fp:
+        fp.write(json.dumps(ttsConfig, indent=4))
+
+    contentFile = os.path.join(casePath, 'content.json')
+
+    content = createContent(size, baseUrl)
+    content['motion'] = motion or ''
+
+    with open(contentFile, 'w') as fp:
+        fp.write(json.dumps(content, indent=4))
+
+    case = {'size': size, 'configFile': configFile, 'ttsConfigFile': ttsConfigFile,
+            'contentFile': contentFile, 'videoFile': os.path.join(casePath, 'video.mp4'),
+            'traceFile': os.path.join(casePath, 'trace.json'), 'resultFile': os.path.join(casePath, 'result.json'),
+            'logFile': os.path.join(casePath, 'log.txt'), 'jobs': jobs, 'cpus': cpus, 'profile': profile}
+
+    caseFile = os.path.join(casePath, 'case.json')
+
+    with open(caseFile, 'w') as fp:
+        fp.write(json.dumps(case, indent=4))
+
+    return caseFile, case
+
+def runCase(caseFile):
+
+    # Run in a child process, so that memory is measured for each case
+    from combiner import Combiner
+    from imgkit import ImageKit
+    from mediaprobe import MediaProbe
+    from network import Network
+    from runner import CommandRunner
+    from tracer import Tracer
+    from tts import Tts
+    from utils import OutputPath
+
+    with open(caseFile) as fp:
+        case = json.loads(fp.read())
+
+    configFile = case['configFile']
+
+    OutputPath.init(configFile)
+
+    Network.init(configFile)
+    Network.setIsEnabled(True)
+
+    CommandRunner.init(configFile)
+    ImageKit.init(configFile, case['cpus'])
+    Tracer.init(case['traceFile'])
+
+    tts = Tts(case['ttsConfigFile'])
+    combiner = Combiner(configFile, True, case['profile'])
+
+    startTime = time.time()
+
+    with Tracer.span('job', 'job', content=case['contentFile'], jobs=case['jobs']):
+        combiner.combine(tts, case['contentFile'], case['videoFile'], case['jobs'], case['cpus'])
+
+    wallTime = time.time() - startTime
+
+    Tracer.save()
+
+    # Stages of all contents are added up
+    stages = dict()
+    audioSeconds = 0.0
+
+    for event in Tracer.getEvents():
+
+        if 'stage' != event['cat']:
+            continue
+
+        stage = stages.setdefault(event['name'], {'time': 0.0, 'count': 0})
+
+        stage['time'] += event['dur'] / 1000000.0
+        stage['count'] += 1
+
+        if 'audio' == event['name']:
+            audioSeconds += event['args'].get('length') or 0.0
+
+    commands = CommandRunner.getStats()
+
+    # Every story is followed by two seconds of separators
+    outputSeconds = MediaProbe.getDuration(case['videoFile'])
+
+    if outputSeconds <= 0.0:
+        outputSeconds = audioSeconds + 2.0 * stages.get('merge', {'count': 0})['count']
+
+    result = {'size': case['size'], 'wallTime': wallTime, 'outputSeconds': outputSeconds,
+            'speed': outputSeconds / wallTime if wallTime > 0 else 0.0,
+            'peakRss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'commandPeakRss': max([stat['maxRss'] for stat in commands.values()] or [0]),
+            'stages': stages, 'commands': commands, 'images': ImageKit.getStats()}
+
+    with open(case['resultFile'], 'w') as fp:
+        fp.write(json.dumps(result, indent=4, sort_keys=True))
+
+def runChild(caseFile, logFile):
+
+    with open(logFile, 'a') as fp:
+        process = subprocess.run([sys.executable, os.path.realpath(__file__), '--case', caseFile],
+                stdout=fp, stderr=subprocess.STDOUT)
+
+    return 0 == process.returncode
+
+def compare(results, baseline, threshold, memoryThreshold):
+
+    # Returns descriptions of regressions
+    regressions = list()
+
+    for size, result in results.items():
+
+        base = baseline.get('cases', dict()).get(size)
+
+        if base is None:
+            print('No baseline for', size)
+            continue
+
+        def check(name, value, baseValue, ratio, isHigherBetter=False):
+
+            if not baseValue:
+                return
+
+            change = (value - baseValue) / baseValue
+
+            print('  {:<16} {:>12.2f} {:>12.2f} {:>+8.1%}'.format(name, value, baseValue, change))
+
+            if (isHigherBetter and change < -ratio) or (not isHigherBetter and change > ratio):
+                regressions.append('{} {}: {:.2f} against {:.2f} ({:+.1%})'.format(size, name, value, baseValue, change))
+
+        print('{}:'.format(size))
+        print('  {:<16} {:>12} {:>12} {:>8}'.format('', 'current', 'baseline', 'change'))
+
+        check('wall time', result['wallTime'], base['wallTime'], threshold)
+        check('speed', result['speed'], base['speed'], threshold, True)
+        check('peak rss', result['peakRss'], base['peakRss'], memoryThreshold)
+        check('command rss', result['commandPeakRss'], base['commandPeakRss'], memoryThreshold)
+
+        for name, stage in sorted(result['stages'].items()):
+
+            baseStage = base['stages'].get(name)
+
+            # Stages under a second are too noisy to be compared
+            if baseStage is not None and max(stage['time'], baseStage['time']) >= 1.0:
+                check(name, stage['time'], baseStage['time'], threshold)
+
+    return regressions
+
+def run(sizes, workPath, outputFile, baselineFile, saveBaseline, threshold, memoryThreshold,
+        font, jobs, cpus, isWarm, latency, engine, profile, imageWorkers=None, motion=None):
+
+    assetPath = os.path.join(workPath, 'assets')
+    os.makedirs(assetPath, exist_ok=True)
+
+    createImages(assetPath)
+
+    StandInHandler.assetPath = assetPath
+    StandInHandler.latency = latency
+
+    # Only listens on localhost
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    baseUrl = 'http://127.0.0.1:{}/'.format(server.server_port)
+
+    results = dict()
+    failures = list()
+
+    try:
+        for size in sizes:
+
+            caseFile, case = createCase(workPath, size, baseUrl, font, jobs, cpus, engine, profile, imageWorkers, motion)
+
+            print('Run', size, 'with', SIZES[size], 'and a log in', case['logFile'])
+
+            # A warm run leaves outputs and caches for the measured one
+            if isWarm and not runChild(caseFile, case['logFile']):
+                failures.append(size)
+                continue
+
+            if not runChild(caseFile, case['logFile']):
+                print('Failed to run', size)
+                failures.append(size)
+                continue
+
+            with open(case['resultFile']) as fp:
+                result = json.loads(fp.read())
+
+            results[size] = result
+
+            print('{}: {:.2f}s wall, {:.2f}s output, {:.2f}x speed, {} KB peak rss, {} KB command peak rss'.format(size,
+                result['wallTime'], result['outputSeconds'], result['speed'], result['peakRss'], result['commandPeakRss']))
+
+            for name, stage in sorted(result['stages'].items(), key=lambda item: -item[1]['time']):
+                print('  {:<12} {:>8.2f}s in {} runs'.format(name, stage['time'], stage['count']))
+
+            images = result.get('images')
+
+            if images and images['count'] > 0:
+                print('  {} frames composed in {:.2f}s with {} image workers'.format(images['count'],
+                    images['time'], images['workers']))
+    finally:
+        server.shutdown()
+
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0],
+            'cpus': os.cpu_count(), 'jobs': jobs, 'warm': isWarm, 'engine': engine,
+            'profile': profile, 'cases': results}
+
+    if outputFile:
+
+        with open(outputFile, 'w') as fp:
+            fp.write(json.dumps(report, indent=4, sort_keys=True))
+
+        print('Results are saved to', outputFile)
+
+    regressions = list()
+
+    if baselineFile and saveBaseline:
+
+        with open(baselineFile, 'w') as fp:
+            fp.write(json.dumps(report, indent=4, sort_keys=True))
+
+        print('Baseline is saved to', baselineFile)
+
+    elif baselineFile:
+
+        with open(baselineFile) as fp:
+            baseline = json.loads(fp.read())
+
+        regressions = compare(results, baseline, threshold, memoryThreshold)
+
+        for regression in regressions:
+            print('Regression:', regression)
+
+    return 0 == len(failures) and 0 == len(regressions)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render synthetic contents offline and measure the pipeline')
+
+    parser.add_argument('--sizes', default='tiny,small',
+            help='comma separated sizes of contents, from {}'.format(', '.join(SIZES.keys())))
+    parser.add_argument('--work-dir', dest='workPath',
+            help='directory of assets, outputs and logs, a temporary one by default')
+    parser.add_argument('-o', '--output', dest='outputFile', help='save results as JSON')
+    parser.add_argument('--baseline', dest='baselineFile', help='compare results with a saved baseline')
+    parser.add_argument('--save-baseline', dest='saveBaseline', action='store_true',
+            help='save results as the baseline instead of comparing with it')
+    parser.add_argument('--threshold', type=float, default=0.2,
+            help='allowed ratio of slowdown against the baseline')
+    parser.add_argument('--memory-threshold', dest='memoryThreshold', type=float, default=0.2,
+            help='allowed ratio of memory growth against the baseline')
+    parser.add_argument('--font', help='font file for titles')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of tasks run in parallel, 1 for a serial run')
+    parser.add_argument('--cpus', type=int, default=None,
+            help='number of cores shared by encoders, all cores by default')
+    parser.add_argument('--warm', dest='isWarm', action='store_true',
+            help='measure a second run which reuses outputs and caches of the first one')
+    parser.add_argument('--latency', type=float, default=0.0,
+            help='seconds added to every response of the local services')
+    parser.add_argument('--engine', default='oddcast', choices=['oddcast', 'espeak'],
+            help='tts engine, oddcast is served by a local stand-in')
+    parser.add_argument('--profile', default='final', choices=['draft', 'preview', 'final'],
+            help='encoder profile')
+    parser.add_argument('--image-workers', dest='imageWorkers', type=int, default=None,
+            help='processes composing frames, 0 to compose them in the rendering threads, all cores by default')
+    parser.add_argument('--motion', choices=['kenburns'],
+            help='render slideshows with motion instead of still images')
+    parser.add_argument('--case', dest='caseFile', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.caseFile:
+        runCase(args.caseFile)
+        sys.exit(0)
+
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+
+    for size in sizes:
+        if size not in SIZES:
+            parser.error('unknown size {}'.format(size))
+
+    if args.saveBaseline and not args.baselineFile:
+        parser.error('--save-baseline needs --baseline')
+
+    workPath = args.workPath or tempfile.mkdtemp(prefix='benchmark-')
+    workPath = os.path.realpath(workPath)
+
+    isPassed = run(sizes, workPath, args.outputFile, args.baselineFile, args.saveBaseline,
+            args.threshold, args.memoryThreshold, args.font, max(1, args.jobs), args.cpus,
+            args.isWarm, args.latency, args.engine, args.profile, args.imageWorkers, args.motion)
+
+    if not args.workPath:
+        shutil.rmtree(workPath, ignore_errors=True)
+
+    sys.exit(0 if isPassed else 1)
+
@@ -1,20 +1,29 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import argparse
 import os
 import sys
 import time
 import traceback
 
-from combiner import Combiner, Tts
+from combiner import Combiner
 from datetime import datetime
+from imgkit import ImageKit
 from network import Network
+from runner import CommandRunner
+from tracer import Tracer
+from tts import Tts
 from utils import reprDict, OutputPath, ThreadWritableObject
 
-def run(name, configFile, ttsConfigFile, contentFile, videoFile, logFile):
+def run(name, configFile, ttsConfigFile, contentFile, videoFile, logFile, jobs=1, withLogo=True, cpus=None,
+        tracePath=None, profileStages=None, memoryStages=None, hlsPath=None, profileName=None):
 
     OutputPath.init(configFile)
 
+    Tracer.init(tracePath, profileStages, memoryStages,
+            tracePath or os.path.join(OutputPath.LOG_OUTPUT_PATH, name))
+
     #thread = ThreadWritableObject(configFile, name, logFile)
     #thread.start()
 
@@ -23,40 +32,69 @@ def run(name, configFile, ttsConfigFile, contentFile, videoFile, logFile):
 
     try:
         print('Now: ', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        Network.init(configFile)
+        CommandRunner.init(configFile)
+        ImageKit.init(configFile, cpus)
         Network.setIsEnabled(True)
         tts = Tts(ttsConfigFile)
-        combiner = Combiner(configFile)
-        combiner.combine(tts, contentFile, videoFile)
+        combiner = Combiner(configFile, withLogo, profileName)
+
+        with Tracer.span('job', 'job', content=contentFile, jobs=jobs):
+            combiner.combine(tts, contentFile, videoFile, jobs, cpus, hlsPath)
     except KeyboardInterrupt:
         pass
     except Exception as e:
         print('Error occurs at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
         traceback.print_exc(file=sys.stdout)
     finally:
-        pass
+        Tracer.save()
 
     #thread.quit()
     #thread.join()
 
 if __name__ == '__main__':
 
-    if len(sys.argv) < 5:
-        print('Usage:\n\t', sys.argv[0], 'config-file tts-config-file content-file video-file [log-file]\n')
-        exit()
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('configFile', metavar='config-file')
+    parser.add_argument('ttsConfigFile', metavar='tts-config-file')
+    parser.add_argument('contentFile', metavar='content-file')
+    parser.add_argument('videoFile', metavar='video-file')
+    parser.add_argument('logFile', metavar='log-file', nargs='?')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+            help='number of tasks run in parallel, 1 for a serial run')
+    parser.add_argument('--cpus', type=int, default=None,
+            help='number of cores shared by encoders, all cores by default')
+    parser.add_argument('--no-logo', dest='withLogo', action='store_false',
+            help='don\'t add logo to videos')
+    parser.add_argument('--profile', dest='profileName', choices=['draft', 'preview', 'final'],
+            help='encoder profile, overrides the one in content-file, final by default')
+    parser.add_argument('--hls', dest='hlsPath', metavar='PLAYLIST',
+            help='also publish every story to an HLS playlist of fMP4 segments as soon as it\'s rendered')
+    parser.add_argument('--trace', dest='tracePath', metavar='TRACE-FILE',
+            help='save spans of the job, its stages, commands and requests as Chrome trace events')
+    parser.add_argument('--cprofile', dest='profileStages', metavar='STAGE', action='append',
+            help='run a stage under cProfile, one of prepare, download, images, tts, audio, '
+            'slideshow, subtitle, merge and concat, repeatable')
+    parser.add_argument('--tracemalloc', dest='memoryStages', metavar='STAGE', action='append',
+            help='report allocations of a stage with tracemalloc, repeatable')
+
+    args = parser.parse_args()
 
     os.environ['TZ'] = 'Asia/Shanghai'
     time.tzset()
 
     name = os.path.basename(sys.argv[0])[:-3] # Remove ".py"
-    configFile = os.path.realpath(sys.argv[1])
-    ttsConfigFile = os.path.realpath(sys.argv[2])
-    contentFile = os.path.realpath(sys.argv[3])
-    videoFile = os.path.realpath(sys.argv[4])
-
-    logFile = None
+    configFile = os.path.realpath(args.configFile)
+    ttsConfigFile = os.path.realpath(args.ttsConfigFile)
+    contentFile = os.path.realpath(args.contentFile)
+    videoFile = os.path.realpath(args.videoFile)
 
-    if len(sys.argv) > 5:
-        logFile = sys.argv[5]
+    logFile = args.logFile
 
-    run(name, configFile, ttsConfigFile, contentFile, videoFile, logFile)
+    tracePath = os.path.realpath(args.tracePath) if args.tracePath else None
+    hlsPath = os.path.realpath(args.hlsPath) if args.hlsPath else None
 
+    run(name, configFile, ttsConfigFile, contentFile, videoFile, logFile, max(1, args.jobs),
+            args.withLogo, args.cpus, tracePath, args.profileStages, args.memoryStages, hlsPath,
+            args.profileName)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+
+class FileCache:
+
+    # Files being written, which are never evicted
+    TEMP_PREFIX = '.tmp'
+
+    def __init__(self, path, maxSize=0):
+
+        self.path = path
+        self.maxSize = maxSize # In bytes, 0 for unlimited
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+
+        # Running total of the cache, so the tree is only walked when it's over the limit
+        self.size = 0
+
+        if self.maxSize > 0:
+            self.size = sum(size for mtime, size, path in self.scan())
+
+        self.mutex = threading.Lock()
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        del state['mutex']
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.mutex = threading.Lock()
+
+    def getPath(self, key, suffix=''):
+        return os.path.join(self.path, key[:2], '{}{}'.format(key, suffix))
+
+    def get(self, key, dstPath, suffix=''):
+
+        path = self.getPath(key, suffix)
+
+        try:
+            shutil.copyfile(path, dstPath)
+
+            # Least recently used files are evicted first
+            os.utime(path)
+
+        except FileNotFoundError:
+
+            self.countMiss()
+            return None
+
+        with self.mutex:
+            self.hits += 1
+
+        return dstPath
+
+    def countMiss(self):
+
+        with self.mutex:
+            self.misses += 1
+
+    def put(self, key, srcPath, suffix=''):
+
+        def write(tempPath):
+            shutil.copyfile(srcPath, tempPath)
+
+        return self.writeImpl(key, suffix, write)
+
+    def read(self, key, suffix=''):
+
+        try:
+            with open(self.getPath(key, suffix), 'rb') as fp:
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, data, suffix=''):
+
+        def write(tempPath):
+            with open(tempPath, 'wb') as fp:
+                fp.write(data)
+
+        return self.writeImpl(key, suffix, write)
+
+    def writeImpl(self, key, suffix, write):
+
+        path = self.getPath(key, suffix)
+        dirname = os.path.dirname(path)
+
+        os.makedirs(dirname, exist_ok=True)
+
+        # Write to a temporary file first, so readers never see a partial file
+        fd, tempPath = tempfile.mkstemp(prefix=FileCache.TEMP_PREFIX, dir=dirname)
+        os.close(fd)
+
+        try:
+            write(tempPath)
+
+            size = os.path.getsize(tempPath)
+
+            try:
+                size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+
+            os.replace(tempPath, path)
+        except:
+            try:
+                os.remove(tempPath)
+            except FileNotFoundError:
+                pass
+            raise
+
+        with self.mutex:
+            self.size += size
+
+        self.evict()
+
+        return path
+
+    def scan(self):
+
+        entries = list()
+
+        for parent, dirnames, filenames in os.walk(self.path):
+
+            for filename in filenames:
+
+                if filename.startswith(FileCache.TEMP_PREFIX):
+                    continue
+
+                path = os.path.join(parent, filename)
+
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                entries.append((st.st_mtime, st.st_size, path))
+
+        return entries
+
+    def evict(self):
+
+        if self.maxSize <= 0:
+            return
+
+        with self.mutex:
+            if self.size <= self.maxSize:
+                return
+
+        # Other processes may share the cache, so the total is counted again from the tree
+        entries = self.scan()
+        totalSize = sum(size for mtime, size, path in entries)
+
+        if totalSize > self.maxSize:
+
+            entries.sort()
+
+            for mtime, size, path in entries:
+
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+                totalSize -= size
+
+                if totalSize <= self.maxSize:
+                    break
+
+        with self.mutex:
+            self.size = totalSize
+
+    def report(self, name):
+        print(name, 'cache:', self.hits, 'hits,', self.misses, 'misses in', self.path)
+
@@ -2,27 +2,51 @@
 # -*- coding:utf-8 -*-
 
 import base64
+import concurrent.futures
 import hashlib
 import json
 import os
-import urllib.parse
+import shutil
+import threading
 
+from audiokit import AudioAssembler
 from imgkit import ImageKit
+from manifest import BuildManifest
+from mediaprobe import MediaProbe
 from network import Network
+from scheduler import Scheduler, Task
+from subtitle import SubtitleWriter
 from urllib.parse import unquote
-from utils import duration2srttime, getMatchString, getProperty, reprDict, runCommand, OutputPath
-from videokit import VideoMaker, VideoKit
+from runner import CommandRunner
+from tracer import Tracer
+from utils import duration2srttime, getProperty, mkdir, OutputPath
+from videokit import EncoderProfile, HlsWriter, VideoKit
+
+def generateContent(configFile, contentConfig, background, logo, voiceIndex, profile, tts, content):
+
+    generator = ContentGenerator(configFile, contentConfig, background, logo, voiceIndex, profile)
+    generator.generate(tts, content)
+
+    return generator.videoPath
 
 class ContentGenerator:
 
-    def __init__(self, configFile, contentConfig, background):
+    def __init__(self, configFile, contentConfig, background, logo=None, voiceIndex=None, profile=None):
 
         self.configFile = configFile
         self.contentConfig = contentConfig
         self.background = background
+        self.logo = logo
+        self.voiceIndex = voiceIndex
+        self.profile = profile or EncoderProfile()
 
         self.coding = self.contentConfig['coding']
 
+        # kenburns for pan, zoom and crossfades, otherwise images are still
+        self.motion = self.contentConfig.get('motion') or ''
+
+        self.videoPath = None
+
     def getValue(self, dictObj, key):
 
         def getDictValue(dictObj, key, coding='plate'):
@@ -42,9 +66,60 @@ class ContentGenerator:
 
         return getDictValue(dictObj, key, self.coding)
 
-    def generate(self, tts, content, silencePath):
+    def generate(self, tts, content):
+
+        with Tracer.span('content', 'content'):
+
+            self.setup(content)
+
+            Tracer.annotate(name=os.path.basename(self.path))
+
+            self.runStage('download', self.downloadImages, self.urls)
+            self.runStage('images', self.createImages)
+
+            self.runStage('tts', self.synthesizeTts, tts, self.text)
+            self.runStage('audio', self.assembleAudio)
+
+            self.runStage('slideshow', self.createSlider)
+            self.runStage('subtitle', self.createSubtitle)
+            self.runStage('merge', self.merge)
+
+    def runStage(self, stage, function, *args):
+
+        with Tracer.span(stage, 'stage', content=os.path.basename(self.path)):
+            return function(*args)
+
+    def schedule(self, scheduler, tts, content):
+
+        self.setup(content)
+
+        name = os.path.basename(self.path)
+
+        downloadTask = scheduler.addTask('{} download'.format(name),
+                lambda threads: self.runStage('download', self.downloadImages, self.urls), resource=Task.NETWORK)
+        imageTask = scheduler.addTask('{} images'.format(name),
+                lambda threads: self.runStage('images', self.createImages), [downloadTask], Task.LIGHT)
+
+        ttsTask = scheduler.addTask('{} tts'.format(name),
+                lambda threads: self.runStage('tts', self.synthesizeTts, tts, self.text), resource=Task.NETWORK)
+        audioTask = scheduler.addTask('{} audio'.format(name),
+                lambda threads: self.runStage('audio', self.assembleAudio), [ttsTask], Task.LIGHT)
+
+        # The slideshow needs the length of audio
+        sliderTask = scheduler.addTask('{} slider'.format(name),
+                lambda threads: self.runStage('slideshow', self.createSlider, threads), [imageTask, audioTask], Task.HEAVY)
+        subtitleTask = scheduler.addTask('{} subtitle'.format(name),
+                lambda threads: self.runStage('subtitle', self.createSubtitle), [audioTask], Task.LIGHT)
+
+        return scheduler.addTask('{} merge'.format(name),
+                lambda threads: self.runStage('merge', self.merge, threads), [sliderTask, subtitleTask], Task.HEAVY)
+
+    def setup(self, content):
 
-        text = self.getValue(content, 'text')
+        self.text = self.getValue(content, 'text')
+        self.urls = content['image-urls-list']
+
+        text = self.text
 
         self.name = self.getValue(content, 'name')
         name = self.name
@@ -66,98 +141,122 @@ class ContentGenerator:
 
         self.path = OutputPath.getDataPath(name)
 
-        self.prepare()
-
-        self.saveImages(content['image-urls-list'])
-        self.generateTts(tts, text, silencePath)
+        # Stages whose inputs are unchanged are skipped
+        self.manifest = BuildManifest(self.path)
 
-        self.createSlider()
-        self.merge()
+        self.prepare()
 
     def prepare(self):
 
-        self.width = int(self.contentConfig['width'])
-        self.height = int(self.contentConfig['height'])
+        self.width, self.height = self.profile.scaleSize(int(self.contentConfig['width']),
+                int(self.contentConfig['height']))
 
         # Font
         self.font = self.contentConfig['font']
         if not self.font:
             self.font = getProperty(self.configFile, 'font-path')
 
-    def merge(self):
+    def createSubtitle(self):
 
-        # Merge image and audio
-        pathname = os.path.join(self.path, 'temp.mp4')
+        # Subtitles are written as ASS with a style for the frame and font, wrapped by glyph widths
+        assPath = os.path.join(self.path, 'subtitle.ass')
 
-        print('Merge', self.imagePath, 'and', self.audioPath, 'to', pathname)
+        fontSize = self.contentConfig.get('font-size')
+        writer = SubtitleWriter(self.width, self.height, self.font,
+                self.profile.scaleValue(int(fontSize)) if fontSize else None)
 
-        cmd = 'ffmpeg -y -i {} -i {} -c copy -map \'0:v:0\' -map \'1:a:0\' {}'.format(self.imagePath,
-                self.audioPath, pathname)
+        def write():
 
-        runCommand(cmd)
+            print('Write', assPath, 'with font', writer.metrics.family, writer.fontSize)
 
-        # Add title
+            writer.write(assPath, self.manifest.getValue('audio', 'cues', list()))
 
-        if self.name and self.font:
+        fingerprint = BuildManifest.fingerprint(self.manifest.getFingerprint('audio'), self.width, self.height,
+                self.font, BuildManifest.fileFingerprint(self.font), writer.fontSize)
+        self.manifest.run('subtitle', fingerprint, [assPath], write)
 
-            titlePath = os.path.join(self.path, 'title.mp4')
+        self.assPath = assPath
 
-            print('Add title for', titlePath)
+    def merge(self, threads=None):
 
-            cmd = ''' ffmpeg -y -i {} -max_muxing_queue_size 10240 -vf drawtext="fontfile={}: \
-                      text='{}': fontcolor=white: fontsize=48: box=1: boxcolor=black@0.1: \
-                      boxborderw=5: shadowcolor=black: shadowx=1: shadowy=1: \
-                      x=(w-text_w)/2: y=20" -codec:a copy {} '''.format(pathname,
-                              self.font, self.name, titlePath)
+        assPath = self.assPath
 
-            runCommand(cmd)
+        # Title, subtitle and logo are burned in and audio is muxed in one encode. Slides are
+        # raised to the output frame rate, and only frames which change are encoded. Motion
+        # changes every frame by less than mpdecimate notices, so all of its frames are kept
+        isStill = 'kenburns' != self.motion
+
+        filters = ['fps={}'.format(self.profile.fps)]
+
+        if self.name and self.font:
+
+            filters.append('drawtext=fontfile={}:text={}:expansion=none:fontcolor=white:fontsize={}:'
+                    'box=1:boxcolor=black@0.1:boxborderw=5:shadowcolor=black:shadowx=1:shadowy=1:'
+                    'x=(w-text_w)/2:y=20'.format(VideoKit.escapeFilterValue(self.font),
+                        VideoKit.escapeFilterValue(self.name), self.profile.scaleValue(48)))
+
+        if self.font:
+            filters.append('ass={}:fontsdir={}'.format(VideoKit.escapeFilterValue(assPath),
+                VideoKit.escapeFilterValue(SubtitleWriter.getFontsDir(self.font))))
         else:
-            titlePath = pathname
+            filters.append('ass={}'.format(VideoKit.escapeFilterValue(assPath)))
 
-        # Create subtitle
-        '''
-            When you create an SRT file in a text editor, you need to format the text
-            correctly and save it as an SRT file. This format should include:
+        self.videoPath = os.path.join(self.path, 'video.mp4')
 
-                [Section of subtitles number]
-                [Time the subtitle is displayed begins]-->[Time the subtitle is displayed ends]
-                [Subtitle]
+        videoArgs = self.profile.getVideoArgs(threads, isStill)
+        decimateFilters = list()
 
-            To format the timestamps correctly, show:
-                [hours]:[minutes]:[seconds],[milliseconds]
-        '''
-        assPath = os.path.join(self.path, 'subtitle.ass')
+        if isStill:
 
-        print('Tranlate', self.subtitlePath, 'to', assPath)
+            videoArgs = ['-vsync', 'vfr'] + videoArgs
+            decimateFilters.append(self.profile.getDecimateFilter())
 
-        cmd = 'ffmpeg -y -i {} {}'.format(self.subtitlePath, assPath)
-        runCommand(cmd)
+        def merge():
 
-        # Add subtitle
-        self.videoPath = os.path.join(self.path, 'video.mp4')
+            print('Merge', self.imagePath, 'and', self.audioPath, 'with title and subtitle to', self.videoPath)
+
+            if self.logo:
+
+                cmd = ['ffmpeg', '-y', '-i', self.imagePath, '-i', self.audioPath, '-i', self.logo,
+                        '-max_muxing_queue_size', '10240',
+                        '-filter_complex', '[0:v]{}[video];[video][2:v]{}[out]'.format(','.join(filters),
+                            ','.join(['overlay=10:10'] + decimateFilters)),
+                        '-map', '[out]', '-map', '1:a:0', '-codec:a', 'copy'] + videoArgs + [self.videoPath]
+            else:
+
+                cmd = ['ffmpeg', '-y', '-i', self.imagePath, '-i', self.audioPath,
+                        '-max_muxing_queue_size', '10240', '-vf', ','.join(filters + decimateFilters),
+                        '-map', '0:v:0', '-map', '1:a:0', '-codec:a', 'copy'] + videoArgs + [self.videoPath]
+
+            CommandRunner.run(cmd)
 
-        print('Add subtitle to', self.videoPath)
-        cmd = 'ffmpeg -y -i {} -max_muxing_queue_size 2048 -vf "ass={}" {}'.format(titlePath, assPath, self.videoPath)
+        fingerprint = BuildManifest.fingerprint(self.manifest.getFingerprint('slideshow'),
+                self.manifest.getFingerprint('audio'), self.manifest.getFingerprint('subtitle'),
+                filters, decimateFilters, BuildManifest.fileFingerprint(self.logo), self.profile.getFingerprint())
 
-        runCommand(cmd)
+        self.manifest.run('merge', fingerprint, [self.videoPath], merge)
 
-    def createSlider(self):
+    def createSlider(self, threads=None):
 
         self.imagePath = os.path.join(self.path, 'image.mp4')
 
         if self.imageCount is 0:
-            print('Create slider to', self.imagePath, 'from', self.background)
 
-            # TODO: Use background as image
-            cmd = 'ffmpeg -y -loop 1 -i {} -c:v libx264 -t {:.2f} -pix_fmt yuv420p {}'.format(self.background,
-                    self.length, self.imagePath)
+            def createSlider():
 
-            runCommand(cmd)
+                print('Create slider to', self.imagePath, 'from', self.background)
+
+                # TODO: Use background as image
+                VideoKit.createLoopVideo(self.imagePath, self.background, self.length, self.profile, threads)
+
+            fingerprint = BuildManifest.fingerprint(BuildManifest.fileFingerprint(self.background), self.length,
+                    self.profile.getFingerprint())
+            self.manifest.run('slideshow', fingerprint, [self.imagePath], createSlider)
 
             return
 
         duration = self.length / self.imageCount
-        videoMaker = None
+        imagePaths = list()
 
         for index in range(self.imageCount):
 
@@ -166,243 +265,321 @@ class ContentGenerator:
             if not os.path.exists(imagePath):
                 continue
 
-            imageVideoPath = '{}.mp4'.format(imagePath)
-            VideoKit.createLoopVideo(imageVideoPath, imagePath, duration)
+            imagePaths.append(imagePath)
 
-            videoMaker = VideoKit.appendVideo(imageVideoPath, videoMaker)
+        fingerprint = BuildManifest.fingerprint(self.frameFingerprints, self.length, self.profile.getFingerprint(),
+                self.motion)
+
+        if 'kenburns' == self.motion:
+            createSlideshow = VideoKit.createMotionSlideshow
+        else:
+            createSlideshow = VideoKit.createSlideshow
 
-        videoMaker.merge(self.imagePath)
+        self.manifest.run('slideshow', fingerprint, [self.imagePath], createSlideshow,
+                self.imagePath, imagePaths, [duration] * len(imagePaths), self.profile, threads)
 
     def saveImages(self, urls):
 
-        def saveImage(path, index, url):
+        self.downloadImages(urls)
+        self.createImages()
 
-            prefix = os.path.join(path, '{}.original'.format(index))
+    def downloadImages(self, urls):
 
-            # TODO: if it already exists
-            pathname = '{}.original.png'.format(prefix)
-            if os.path.exists(pathname):
-                return pathname
+        def getSavedImage(prefix):
 
-            pathname = '{}.original.jpg'.format(prefix)
-            if os.path.exists(pathname):
-                return pathname
+            for suffix in ['jpg', 'png', 'gif']:
 
-            pathname = '{}.original.gif'.format(prefix)
-            if os.path.exists(pathname):
-                return pathname
+                pathname = '{}.{}'.format(prefix, suffix)
+                if os.path.exists(pathname):
+                    return pathname
 
-            return Network.saveUrl(prefix, url)
+            return None
 
-        index = 0
-        for url in urls:
+        # Download concurrently, files are named by the positions in the list
+        imagePaths = list()
+        items = list()
+        downloadingImages = list()
+
+        for position, url in enumerate(urls):
 
             if not url:
                 continue
 
-            imagePath = saveImage(self.path, index, url)
+            prefix = os.path.join(self.path, '{}.original'.format(position))
+
+            stage = 'download:{}'.format(position)
+            fingerprint = BuildManifest.fingerprint(url)
+
+            imagePath = getSavedImage(prefix)
+
+            image = [position, stage, fingerprint, imagePath]
+
+            if not self.manifest.isFresh(stage, fingerprint, [imagePath]):
+
+                self.manifest.invalidate(stage)
+
+                image[3] = None
+
+                items.append((prefix, url))
+                downloadingImages.append(image)
+
+            imagePaths.append(image)
+
+        Tracer.annotate(images=len(imagePaths), downloads=len(items))
+
+        # Frames are composed in the image pool as soon as their images are saved
+        self.frames = dict()
+
+        for image in imagePaths:
+            if image[3] is not None:
+                self.composeFrame(image)
+
+        futures = dict(zip(Network.submitUrls(items), downloadingImages))
+
+        for future in concurrent.futures.as_completed(futures):
+
+            image = futures[future]
+
+            try:
+                imagePath = future.result()
+            except Exception as e:
+                print('Error to save', ':', e)
+                imagePath = None
 
             if imagePath is not None:
 
-                # To jpg
-                if not imagePath.endswith('.jpg'):
+                # PNG and GIF are decoded as they are when frames are composed
+                image[3] = imagePath
+                self.manifest.update(image[1], image[2])
+
+                self.composeFrame(image)
 
-                    oldPath = imagePath
-                    imagePath = os.path.join(self.path, '{}.original.jpg'.format(index))
+        self.downloads = imagePaths
 
-                    print('Translate', oldPath, 'to', imagePath)
+    def composeFrame(self, image):
 
-                    cmd = 'ffmpeg -y -i {} {}'.format(oldPath, imagePath)
-                    runCommand(cmd)
+        position, downloadStage, downloadFingerprint, imagePath = image
 
-                # Backgroud image
-                cropPath = os.path.join(self.path, '{}.crop.jpg'.format(index))
-                bgPath = os.path.join(self.path, '{}.bg.jpg'.format(index))
+        framePath = os.path.join(self.path, '{}.frame.jpg'.format(position))
 
-                print('Create background to', bgPath)
+        stage = 'frame:{}'.format(position)
+        fingerprint = BuildManifest.fingerprint(downloadFingerprint, self.width, self.height, 'compose')
 
-                ImageKit.crop(cropPath, imagePath, (self.width, self.height))
-                ImageKit.blurdim(bgPath, cropPath)
+        if self.manifest.isFresh(stage, fingerprint, [framePath]):
+            print('Skip', stage, 'in', self.path)
+            return
 
-                # Scale image
-                scalePath = os.path.join(self.path, '{}.scale.jpg'.format(index))
+        self.manifest.invalidate(stage)
 
-                print('Scale', imagePath, 'to', scalePath)
+        # Background, scaled image and overlay in one pass
+        print('Create frame', framePath, 'from', imagePath)
 
-                cmd = 'ffmpeg -y -i {0} -vf scale="\'if(gt(a,{1}/{2}),{1},-1)\':\'if(gt(a,{1}/{2}),-1,{2})\'" {3}'.format(imagePath,
-                        self.width, self.height, scalePath)
+        self.frames[position] = (stage, fingerprint,
+                ImageKit.composeAsync(framePath, imagePath, (self.width, self.height)))
 
-                runCommand(cmd)
+    def createImages(self):
 
-                # Overlay background
-                overlayPath = os.path.join(self.path, '{}.jpg'.format(index))
+        # Number images in the order of the list, skipping failed downloads
+        index = 0
+        self.frameFingerprints = list()
+
+        for position, downloadStage, downloadFingerprint, imagePath in self.downloads:
+
+            if imagePath is not None:
+
+                framePath = os.path.join(self.path, '{}.frame.jpg'.format(position))
+
+                if position in self.frames:
+
+                    stage, fingerprint, future = self.frames[position]
+
+                    future.result()
+                    self.manifest.update(stage, fingerprint)
 
-                print('Overlay', bgPath, 'to', overlayPath)
+                self.frameFingerprints.append(self.manifest.getFingerprint('frame:{}'.format(position)))
 
-                cmd = 'ffmpeg -y -i {} -i {} -filter_complex "overlay=x=(main_w-overlay_w)/2:y=(main_h-overlay_h)/2" {}'.format(bgPath,
-                        scalePath, overlayPath)
+                overlayPath = os.path.join(self.path, '{}.jpg'.format(index))
+
+                if os.path.exists(overlayPath):
+                    os.remove(overlayPath)
 
-                runCommand(cmd)
+                try:
+                    os.link(framePath, overlayPath)
+                except OSError:
+                    shutil.copyfile(framePath, overlayPath)
 
                 index += 1
 
         self.imageCount = index
 
-    def generateTts(self, tts, text, silencePath):
+        Tracer.annotate(images=index, workers=ImageKit.workers)
 
-        def generateTtsWithIndex(tts, path, index, segment):
+    def generateTts(self, tts, text):
 
-            prefix = os.path.join(path, '{}'.format(index))
+        self.synthesizeTts(tts, text)
+        self.assembleAudio()
 
-            # TODO: if it already exists
-            pathname = '{}.mp3'.format(prefix)
-            if os.path.exists(pathname):
-                return pathname
+    def synthesizeTts(self, tts, text):
 
-            return tts.generateTts(prefix, segment)
+        def generateTtsWithIndexes(tts, path, segments):
 
-        def getAudioLength(pathname):
+            audioPaths = list()
+            items = list()
 
-            import re
+            for index, segment in segments:
 
-            # Get length of audio
-            print('Get length of', pathname)
+                prefix = os.path.join(path, '{}'.format(index))
+                pathname = '{}{}'.format(prefix, tts.getSuffix())
 
-            cmd = 'ffmpeg -v quiet -stats -i {} -f null -'.format(pathname)
+                # Reuse it only if it's synthesized from the same text and voice
+                stage = 'tts:{}'.format(index)
+                fingerprint = tts.getChecksum(segment, self.voiceIndex)
 
-            output = runCommand(cmd)
+                if self.manifest.isFresh(stage, fingerprint, [pathname]):
+                    audioPaths.append(pathname)
+                else:
+                    self.manifest.invalidate(stage)
 
-            timeString = b'time='
-            start = output.find(timeString)
+                    audioPaths.append(None)
+                    items.append((index, prefix, segment, stage, fingerprint))
 
-            if start > 0:
-                start += len(timeString)
-                end = output.find(b' ', start)
+            Tracer.annotate(segments=len(segments), synthesized=len(items))
 
-                if end > 0:
-                    array = list(map(int, re.findall(b'\d+', output[start:end])))
-                    if len(array) is 4:
-                        length = array[0] * 360000 + array[1] * 6000 + array[2] * 100 + array[3]
-                        return float(length) / 100
+            generatedPaths = tts.synthesizeMany([(prefix, segment) for index, prefix, segment, stage, fingerprint in items],
+                    self.voiceIndex)
 
-            return 0.0
+            for (index, prefix, segment, stage, fingerprint), pathname in zip(items, generatedPaths):
 
-        def getAudioLengthYet(pathname):
+                audioPaths[index] = pathname
 
-            # Get length of audio
-            print('Get length of', pathname)
+                if pathname is not None:
+                    self.manifest.update(stage, fingerprint)
 
-            cmd = 'sox {} -n stat'.format(pathname)
+            return audioPaths
 
-            output = runCommand(cmd)
+        # Split text into segments, None stands for a silence between them
+        plan = list()
 
-            lengthString = b'\nLength (seconds):'
-            start = output.find(lengthString)
+        length = len(text)
 
-            if start > 0:
-                start += len(lengthString)
-                end = output.find(b'\n', start)
+        start = 0
+        index = 0
 
-                if end > 0:
-                    return float(output[start:end])
+        while start < length:
 
-            return 0.0
+            end = text.find('\n', start)
+            if end < 0:
+                end = length - 1
 
-        self.length = 0.0
+            # TODO: text should NOT start with '\n'
+            if index > 0:
+                plan.append(None)
 
-        try:
+            if end > start:
+                segment = text[start:end]
 
-            audioConfigPath = os.path.join(self.path, 'audio.txt')
-            audioFp = open(audioConfigPath, 'w', encoding='utf-8')
-            self.subtitlePath = os.path.join(self.path, 'subtitle.srt')
-            srtFp = open(self.subtitlePath, 'w')
+                if len(segment.encode('utf-8')) < tts.maxLength:
 
-            length = len(text)
+                    plan.append((index, segment))
+                    index += 1
 
-            start = 0
-            index = 0
+                else:
+                    print('A segment started from position', start,
+                            'is longer than', tts.maxLength,
+                            ':', segment)
+                    break
 
-            while start < length:
+            start = end + 1
 
-                end = text.find('\n', start)
-                if end < 0:
-                    end = length - 1
-                
-                # TODO: text should NOT start with '\n'
-                if index > 0:
+        # Synthesize all segments concurrently
+        self.plan = plan
+        self.audioPaths = generateTtsWithIndexes(tts, self.path,
+                [item for item in plan if item is not None])
 
-                    self.length += 1.0 # Increase audio length
+        if tts.cache is not None:
+            tts.cache.report('TTS')
 
-                    audioFp.write('file \'{}\'\n'.format(silencePath))
+    def assembleAudio(self):
 
-                if end > start:
-                    segment = text[start:end]
+        plan = self.plan
+        audioPaths = self.audioPaths
 
-                    if len(segment.encode('utf-8')) < tts.maxLength:
+        self.length = 0.0
 
-                        audioPath = generateTtsWithIndex(tts, self.path, index, segment)
+        if 0 == len(audioPaths):
+            return
 
-                        if audioPath is not None:
+        self.subtitlePath = os.path.join(self.path, 'subtitle.srt')
+        self.audioPath = os.path.join(self.path, 'audio.m4a')
 
-                            audioFp.write('file \'{}\'\n'.format(audioPath))
+        fingerprint = BuildManifest.fingerprint([None if item is None else
+            self.manifest.getFingerprint('tts:{}'.format(item[0])) for item in plan],
+            AudioAssembler.SAMPLE_RATE, AudioAssembler.CHANNELS, self.profile.audioBitrate, 'cues')
 
-                            audioLength = self.length + getAudioLength(audioPath)
+        if self.manifest.isFresh('audio', fingerprint, [self.subtitlePath, self.audioPath]):
 
-                            srtFp.write('{}\n{} --> {}\n{}\n\n'.format((index + 1),
-                                duration2srttime(self.length), duration2srttime(audioLength),
-                                segment))
+            print('Skip audio in', self.path)
 
-                            self.length = audioLength
+            self.length = self.manifest.getValue('audio', 'length')
+            Tracer.annotate(length=self.length, skipped=True)
 
-                        index += 1
+            return
 
-                    else:
-                        print('A segment started from position', start,
-                                'is longer than', tts.maxLength,
-                                ':', segment)
-                        break
+        self.manifest.invalidate('audio')
 
-                start = end + 1
+        # Decode all segments to PCM once, timings come from sample counts
+        assembler = AudioAssembler()
 
-        finally:
-            if audioFp is not None:
-                audioFp.close()
+        decodedPaths = [audioPath for audioPath in audioPaths if audioPath is not None]
+        samples = dict(zip(decodedPaths, assembler.decodeMany(decodedPaths)))
 
-            if srtFp is not None:
-                srtFp.close()
+        # Timings of segments are kept for the subtitle stage
+        cues = list()
 
-        if index is 0:
-            return
+        with open(self.subtitlePath, 'w') as srtFp:
 
-        # Concat all audio
-        pathname = os.path.join(self.path, 'audio.mp3')
+            for item in plan:
 
-        if index is 1:
-            print('Rename', audioPath, 'to', pathname)
-            cmd = 'mv {} {}'.format(audioPath, pathname)
+                if item is None:
+                    assembler.appendSilence(1.0)
+                    continue
 
-        else:
-            print('Create', pathname)
-            cmd = 'ffmpeg -y -f concat -safe 0 -i {0} -c copy {1}'.format(audioConfigPath,
-                    pathname)
+                index, segment = item
+                audioPath = audioPaths[index]
 
-        runCommand(cmd)
+                if audioPath is not None:
 
-        # To m4a
-        self.audioPath = '{}m4a'.format(pathname[:-3])
+                    start, end = assembler.appendSamples(samples[audioPath])
+
+                    srtFp.write('{}\n{} --> {}\n{}\n\n'.format((index + 1),
+                        duration2srttime(start), duration2srttime(end), segment))
+
+                    cues.append([start, end, segment])
 
-        print('Translate', pathname, 'to', self.audioPath)
-        cmd = 'ffmpeg -y -i {} -vn -acodec aac -strict -2 \'-bsf:a\' aac_adtstoasc {}'.format(pathname,
-                self.audioPath)
+        self.length = assembler.getLength()
+        Tracer.annotate(length=self.length, skipped=False)
 
-        runCommand(cmd)
+        # Encode AAC only once
+        assembler.encode(self.audioPath, self.profile.audioBitrate)
+
+        self.manifest.update('audio', fingerprint, length=self.length, cues=cues)
 
 class Combiner:
 
-    def __init__(self, configFile):
+    # Prepared logo, background and separator by their parameters, shared by all combines in a process
+    preparedAssets = dict()
+    prepareMutex = threading.Lock()
+
+    def __init__(self, configFile, withLogo=True, profileName=None):
         self.configFile = configFile
+        self.withLogo = withLogo
+        self.profileName = profileName
 
-    def combine(self, tts, contentFile, videoFile):
+    def combine(self, tts, contentFile, videoFile, jobs=1, cpus=None, hlsPath=None):
+
+        # Nothing of a previous combine is left, as one combiner renders many content files
+        self.contentConfig = None
+        self.videoPath = None
 
         with open(contentFile) as fp:
             contentConfig = json.loads(fp.read())
@@ -413,7 +590,13 @@ class Combiner:
 
         self.contentConfig = contentConfig
 
-        self.prepare()
+        # A profile of the run overrides the one of contents
+        self.profile = EncoderProfile(self.profileName or self.contentConfig.get('profile') or 'final')
+
+        print('Encode with the', self.profile.name, 'profile')
+
+        with Tracer.span('prepare', 'stage'):
+            self.prepare()
 
         videos = list()
 
@@ -421,223 +604,245 @@ class Combiner:
 
         tts.setLanguage(self.contentConfig['language'])
 
-        for content in self.contentConfig['contents-list']:
+        contents = self.contentConfig['contents-list']
+
+        # Decide voices up front so that every content has the same voice as in a serial run
+        voiceIndexes = list()
+
+        for content in contents:
 
             tts.switchVoice()
+            voiceIndexes.append(tts.voiceIndex)
 
-            generator = ContentGenerator(self.configFile, self.contentConfig, self.background)
-            generator.generate(tts, content, self.silencePath)
+        # Stories are also published as soon as they and all stories before them are done
+        if hlsPath:
+            writer = HlsWriter(hlsPath, self.separatorPath, keyframeInterval=self.profile.gop)
+        else:
+            writer = None
 
-            if generator.videoPath is not None:
-                videos.append(generator.videoPath)
+        try:
+            self.render(tts, contents, voiceIndexes, videos, jobs, cpus, writer)
+        finally:
+            if writer is not None:
+                writer.close()
 
-        self.postProcess(videos, videoFile)
+        with Tracer.span('concat', 'stage', videos=len(videos)):
+            self.postProcess(videos, videoFile)
 
-    def prepare(self):
+        if Network.cache is not None:
+            Network.cache.report('URL')
 
-        self.width = int(self.contentConfig['width'])
-        self.height = int(self.contentConfig['height'])
+        CommandRunner.report()
+        ImageKit.report()
 
-        # Logo:
-        logo = self.contentConfig['logo']
+    def render(self, tts, contents, voiceIndexes, videos, jobs, cpus, writer):
 
-        if logo:
-            prefix = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'logo.original')
-            logo = Network.saveUrl(prefix, logo)
-        else:
-            logo = getProperty(self.configFile, 'logo-path')
+        if jobs > 1 and len(contents) > 1:
 
-        if logo:
-            self.logo = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'logo.jpg')
+            # All stages of all contents are run as a graph of tasks
+            scheduler = Scheduler(jobs, cpus)
 
-            logoWidth = int(self.contentConfig['logo-width'])
-            logoHeight = int(self.contentConfig['logo-height'])
+            print('Render', len(contents), 'contents with', scheduler.jobs, 'jobs on', scheduler.cpus, 'cores')
 
-            print('Create logo', self.logo, 'from', logo)
+            generators = list()
 
-            '''
-            cmd = 'ffmpeg -y -i {} -vf scale="{}:{}" {}'.format(logo,
-                    logoWidth, logoHeight, self.logo)
+            for index, (content, voiceIndex) in enumerate(zip(contents, voiceIndexes)):
 
-            runCommand(cmd)
-            '''
+                generator = ContentGenerator(self.configFile, self.contentConfig,
+                        self.background, self.logo, voiceIndex, self.profile)
 
-            ImageKit.stretch(self.logo, logo, (logoWidth, logoHeight))
-        else:
-            self.logo = None
+                mergeTask = generator.schedule(scheduler, tts, content)
 
-        # Background:
-        background = self.contentConfig['background']
+                if writer is not None:
+                    mergeTask.callback = lambda task, index=index, generator=generator: writer.complete(index,
+                            generator.videoPath if task.error is None else None)
 
-        if background:
-            prefix = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'background.original')
-            background = Network.saveUrl(prefix, background)
+                generators.append(generator)
+
+            with Tracer.span('schedule', 'schedule', jobs=scheduler.jobs, cpus=scheduler.cpus):
+                scheduler.run()
+
+            # Keep the original order
+            for generator in generators:
+                if generator.videoPath is not None:
+                    videos.append(generator.videoPath)
         else:
-            background = getProperty(self.configFile, 'background-path')
 
-        if background:
-            self.background = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'background.jpg')
-            scalePath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'bg-scale.jpg')
+            for index, (content, voiceIndex) in enumerate(zip(contents, voiceIndexes)):
 
-            print('Create background', self.background, 'from', background)
+                videoPath = generateContent(self.configFile, self.contentConfig,
+                        self.background, self.logo, voiceIndex, self.profile, tts, content)
 
-            '''
-            cmd = 'ffmpeg -y -i {} -vf scale="{}:{}" {}'.format(background,
-                    self.width, self.height, self.background)
+                if writer is not None:
+                    writer.complete(index, videoPath)
 
-            runCommand(cmd)
-            '''
+                if videoPath is not None:
+                    videos.append(videoPath)
 
-            ImageKit.crop(scalePath, background, (self.width, self.height))
-            ImageKit.blurdim(self.background, scalePath)
-        else:
-            self.background = None
+    def prepare(self):
 
-        # Create silence
-        self.silencePath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'silence.mp3')
+        self.width, self.height = self.profile.scaleSize(int(self.contentConfig['width']),
+                int(self.contentConfig['height']))
 
-        print('Create silence in', self.silencePath)
+        logoSize = (self.profile.scaleValue(int(self.contentConfig['logo-width'])),
+                self.profile.scaleValue(int(self.contentConfig['logo-height'])))
 
-        cmd = 'ffmpeg -y -f lavfi -i anullsrc=r=22050:cl=mono -t 1 -q:a 9 -acodec libmp3lame {}'.format(self.silencePath)
-        runCommand(cmd)
+        # Sources are downloaded by each combine, as they may be revalidated, but other
+        # assets are created only once for the same sources and parameters
+        with Combiner.prepareMutex:
 
-        # To m4a
-        audioPath = '{}m4a'.format(self.silencePath[:-3])
+            # Logo:
+            logo = self.contentConfig['logo']
 
-        print('Translate', self.silencePath, 'to', audioPath)
-        cmd = 'ffmpeg -y -i {} -vn -acodec aac -strict -2 \'-bsf:a\' aac_adtstoasc {}'.format(self.silencePath,
-                audioPath)
+            if not self.withLogo:
+                logo = None
+            elif logo:
+                prefix = os.path.join(OutputPath.getDataRoot(), 'logo.original')
+                logo = Network.saveUrl(prefix, logo)
+            else:
+                logo = getProperty(self.configFile, 'logo-path')
 
-        runCommand(cmd)
+            # Background:
+            background = self.contentConfig['background']
 
-        # Create separator between videos
-        separatorPath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'image.mp4')
+            if background:
+                prefix = os.path.join(OutputPath.getDataRoot(), 'background.original')
+                background = Network.saveUrl(prefix, background)
+            else:
+                background = getProperty(self.configFile, 'background-path')
 
-        print('Create separator in', separatorPath)
+            key = BuildManifest.fingerprint(self.width, self.height, logoSize if logo else None,
+                    BuildManifest.fileFingerprint(logo), BuildManifest.fileFingerprint(background),
+                    AudioAssembler.SAMPLE_RATE, self.profile.getFingerprint(), 'compose')
 
-        cmd = 'ffmpeg -y -loop 1 -i {} -c:v libx264 -t 1 -pix_fmt yuv420p {}'.format(self.background,
-                separatorPath)
+            assets = Combiner.preparedAssets.get(key)
 
-        runCommand(cmd)
+            if assets is None:
+                assets = self.prepareAssets(key, logo, background, logoSize)
+                Combiner.preparedAssets[key] = assets
+            else:
+                print('Reuse prepared assets of', key)
+                Tracer.annotate(assets=key, reused=True)
 
-        # Merge image and audio
-        self.separatorPath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'separator.mp4')
+        self.logo, self.background, self.separatorPath = assets
 
-        print('Merge', separatorPath, 'and', audioPath, 'to', self.separatorPath)
+    def prepareAssets(self, key, logo, background, logoSize):
 
-        cmd = 'ffmpeg -y -i {} -i {} -c copy -map \'0:v:0\' -map \'1:a:0\' {}'.format(separatorPath,
-                audioPath, self.separatorPath)
+        # Assets are kept with caches, so they're reused by later runs too
+        path = OutputPath.getCachePath('assets') or os.path.join(OutputPath.getDataRoot(), 'assets')
+        mkdir(path)
 
-        runCommand(cmd)
+        path = os.path.join(path, key)
+        mkdir(path)
 
-    def postProcess(self, videos, videoFile):
+        manifest = BuildManifest(path)
 
-        if len(videos) is 0:
-            return
+        logoPath = os.path.join(path, 'logo.jpg') if logo else None
+        backgroundPath = os.path.join(path, 'background.jpg') if background else None
+        separatorPath = os.path.join(path, 'separator.mp4')
 
-        # Merge all videos
-        configPath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'video.txt')
+        outputs = [pathname for pathname in [logoPath, backgroundPath, separatorPath] if pathname]
 
-        with open(configPath, 'w') as fp:
-            for video in videos:
-                fp.write('file \'{}\'\n'.format(video))
-                fp.write('file \'{}\'\n'.format(self.separatorPath))
-                fp.write('file \'{}\'\n'.format(self.separatorPath))
+        if manifest.isFresh('assets', key, outputs):
 
-        videoPath = os.path.join(OutputPath.DATA_OUTPUT_PATH, 'all.mp4')
+            print('Reuse prepared assets in', path)
+            Tracer.annotate(assets=key, reused=True)
 
-        print('Merge all to', videoPath, 'from', configPath)
-        cmd = 'ffmpeg -y -f concat -safe 0 -i {} -c copy {}'.format(configPath, videoPath)
+            return logoPath, backgroundPath, separatorPath
 
-        runCommand(cmd)
+        manifest.invalidate('assets')
 
-        # Add logo
-        self.videoPath = videoFile
+        Tracer.annotate(assets=key, reused=False)
 
-        if self.logo:
+        if logo:
 
-            print('Add logo to', self.videoPath)
-            cmd = 'ffmpeg -y -i {} -i {} -max_muxing_queue_size 10240 -filter_complex "overlay=10:10" {}'.format(videoPath,
-                    self.logo, self.videoPath)
-        else:
-            print('Rename', videoPath, 'to', self.videoPath)
-            cmd = 'mv {} {}'.format(videoPath, self.videoPath)
+            print('Create logo', logoPath, 'from', logo)
+
+            '''
+            cmd = 'ffmpeg -y -i {} -vf scale="{}:{}" {}'.format(logo,
+                    logoWidth, logoHeight, self.logo)
 
-        runCommand(cmd)
+            runCommand(cmd)
+            '''
 
-class Tts:
+            ImageKit.stretch(logoPath, logo, logoSize)
 
-    def __init__(self, pathname):
+        if background:
 
-        with open(pathname) as fp:
-            self.config = json.loads(fp.read())
+            print('Create background', backgroundPath, 'from', background)
 
-            self.maxLength = int(self.config['max-length'])
+            '''
+            cmd = 'ffmpeg -y -i {} -vf scale="{}:{}" {}'.format(background,
+                    self.width, self.height, self.background)
 
-    def setLanguage(self, language):
+            runCommand(cmd)
+            '''
 
-        for lang in self.config['languages']:
-            if language.lower() == lang['name']:
-                self.language = lang
-                break
+            backgroundFuture = ImageKit.composeAsync(backgroundPath, background, (self.width, self.height), False)
         else:
-            print('Not support language', language)
+            backgroundFuture = None
 
-        self.voiceIndex = None
+        # Create silence
+        silencePath = os.path.join(path, 'silence.mp3')
 
-    def switchVoice(self):
+        print('Create silence in', silencePath)
 
-        if self.voiceIndex is None:
-            self.voiceIndex = 0
-        else:
-            self.voiceIndex += 1
+        CommandRunner.run(['ffmpeg', '-y', '-f', 'lavfi', '-i', 'anullsrc=r={}:cl=mono'.format(AudioAssembler.SAMPLE_RATE),
+            '-t', '1', '-q:a', '9', '-acodec', 'libmp3lame', silencePath])
+
+        # To m4a
+        audioPath = '{}m4a'.format(silencePath[:-3])
+
+        print('Translate', silencePath, 'to', audioPath)
+        CommandRunner.run(['ffmpeg', '-y', '-i', silencePath, '-vn', '-acodec', 'aac', '-strict', '-2',
+            '-b:a', self.profile.audioBitrate, '-bsf:a', 'aac_adtstoasc', audioPath])
 
-            if self.voiceIndex >= len(self.language['voiceIds']):
-                self.voiceIndex = 0
+        # The background is composed while silence is created
+        if backgroundFuture is not None:
+            backgroundFuture.result()
 
-    def generateTts(self, prefix, text):
+        # Create separator between videos
+        imagePath = os.path.join(path, 'image.mp4')
 
-        url = self.config['url']
+        print('Create separator in', imagePath)
 
-        accountId = self.config['accountId'] 
-        secretId = self.config['secretId'] 
+        if logoPath:
+            CommandRunner.run(['ffmpeg', '-y', '-loop', '1', '-framerate', self.profile.fps, '-i', backgroundPath,
+                '-i', logoPath, '-filter_complex', 'overlay=10:10', '-t', '1']
+                + self.profile.getVideoArgs(isStill=True) + [imagePath])
+        else:
+            VideoKit.createLoopVideo(imagePath, backgroundPath, 1, self.profile, fps=self.profile.fps)
 
-        preparation = self.config['preparation']
-        download = self.config['download']
+        # Merge image and audio
+        print('Merge', imagePath, 'and', audioPath, 'to', separatorPath)
 
-        languageId = self.language['languageId']
-        voiceId = self.language['voiceIds'][self.voiceIndex]
+        CommandRunner.run(['ffmpeg', '-y', '-i', imagePath, '-i', audioPath, '-c', 'copy',
+            '-map', '0:v:0', '-map', '1:a:0', separatorPath])
 
-        m = hashlib.md5()
+        manifest.update('assets', key)
 
-        m.update(preparation['EID'].encode('utf-8'))
-        m.update(languageId.encode('utf-8'))
-        m.update(voiceId.encode('utf-8'))
-        m.update(text.encode('utf-8'))
-        m.update(preparation['IS_UTF8'].encode('utf-8'))
-        m.update(preparation['EXT'].encode('utf-8'))
-        m.update(accountId.encode('utf-8'))
-        m.update(secretId.encode('utf-8'))
+        return logoPath, backgroundPath, separatorPath
 
-        cs = m.hexdigest()
+    def postProcess(self, videos, videoFile):
 
-        preparation['LID'] = languageId
-        preparation['VID'] = voiceId
-        preparation['ACC'] = accountId
-        preparation['TXT'] = text
-        preparation['CS'] = cs
+        if len(videos) is 0:
+            return
 
-        download['LID'] = languageId
-        download['VID'] = voiceId
-        download['ACC'] = accountId
-        download['TXT'] = text
-        download['CS'] = cs
+        # Merge all videos
+        configPath = os.path.join(OutputPath.getDataRoot(), 'video.txt')
 
-        preparationUrl = '{}{}'.format(url, urllib.parse.urlencode(preparation))
+        with open(configPath, 'w') as fp:
+            for video in videos:
+                fp.write('file {}\n'.format(VideoKit.quoteConcatPath(video)))
+                fp.write('file {}\n'.format(VideoKit.quoteConcatPath(self.separatorPath)))
+                fp.write('file {}\n'.format(VideoKit.quoteConcatPath(self.separatorPath)))
 
-        Network.get(preparationUrl)
+        # Logo is already in every video, so just copy streams
+        if not MediaProbe.isConcatCompatible(videos + [self.separatorPath]):
+            print('Warning: videos have different stream parameters to be concatenated')
 
-        downloadUrl = '{}{}'.format(url, urllib.parse.urlencode(download))
+        self.videoPath = videoFile
 
-        return Network.saveUrl(prefix, downloadUrl)
+        print('Merge all to', self.videoPath, 'from', configPath)
+        CommandRunner.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', configPath, '-c', 'copy', self.videoPath])
 
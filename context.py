@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import threading
+
+class JobContext:
+
+    # Values of the job run by the current thread, e.g. its cancel event, log and data path
+    _local = threading.local()
+
+    @staticmethod
+    def get(name, defaultValue=None):
+        return JobContext.getValues().get(name, defaultValue)
+
+    @staticmethod
+    def getValues():
+        return getattr(JobContext._local, 'values', dict())
+
+    @staticmethod
+    def setValues(values):
+        JobContext._local.values = dict(values)
+
+    @staticmethod
+    def wrap(function):
+
+        # Threads started for a job inherit its values
+        values = JobContext.getValues()
+
+        def run(*args, **kwargs):
+
+            savedValues = JobContext.getValues()
+            JobContext.setValues(values)
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                JobContext.setValues(savedValues)
+
+        return run
@@ -1,59 +1,191 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+
 from wand.image import Image as WandImage
 from wand.color import Color
-from PIL import Image, ImageFilter
-from resizeimage import resizeimage
+from PIL import Image, ImageFilter, ImageOps
+from tracer import Tracer
+from utils import getProperty
 
 class ImageKit:
 
+    # Processes composing frames, 0 to compose them in the calling thread as on a single core
+    workers = 0
+
+    _mutex = threading.Lock()
+    _stats = {'count': 0, 'time': 0.0}
+
+    _pid = None
+    _executor = None
+
+    @staticmethod
+    def init(configFile, cpus=None):
+
+        # Composing shares the core budget of the encoders by default
+        cpus = max(1, cpus or os.cpu_count() or 1)
+        ImageKit.workers = cpus if cpus > 1 else 0
+
+        workers = getProperty(configFile, 'image-workers')
+        if workers:
+            ImageKit.workers = max(0, int(workers))
+
+    @staticmethod
+    def getExecutor():
+
+        with ImageKit._mutex:
+
+            # A forked process doesn't inherit the pool of its parent
+            if ImageKit._pid != os.getpid():
+
+                ImageKit._pid = os.getpid()
+                ImageKit._executor = None
+
+            if ImageKit.workers < 1:
+                return None
+
+            # Spawned processes don't inherit the threads and locks of this one
+            if ImageKit._executor is None:
+                ImageKit._executor = concurrent.futures.ProcessPoolExecutor(max_workers=ImageKit.workers,
+                        mp_context=multiprocessing.get_context('spawn'))
+
+            return ImageKit._executor
+
     @staticmethod
-    def crop(dstFile, srcFile, dstSize):
+    def composeAsync(dstFile, srcFile, dstSize, isOverlaid=True):
+
+        # Pixels stay in the pool, only paths and times are passed between processes
+        executor = ImageKit.getExecutor()
 
-        with open(srcFile, 'rb') as srcFp:
-            with Image.open(srcFp) as image:
+        if executor is not None:
 
-                width = int(dstSize[1] * image.width / image.height)
-                height = int(dstSize[0] * image.height / image.width)
+            # Spans of the workers aren't recorded, so the time of each frame is traced here
+            future = executor.submit(ImageKit.composeTimed, dstFile, srcFile, dstSize, isOverlaid)
+            future.add_done_callback(lambda f: ImageKit.trace(f, dstSize))
+        else:
+            future = concurrent.futures.Future()
 
-                if width < dstSize[0]:
-                    width = dstSize[0]
-                elif height < dstSize[1]:
-                    height = dstSize[1]
+            try:
+                future.set_result(ImageKit.composeTimed(dstFile, srcFile, dstSize, isOverlaid))
+            except Exception as e:
+                future.set_exception(e)
 
-        pos = dstFile.rfind('.')
-        tempFile = '{}.tmp{}'.format(dstFile[:pos], dstFile[pos:])
-        ImageKit.stretch(tempFile, srcFile, (width, height))
+        future.add_done_callback(ImageKit.record)
+
+        return future
+
+    @staticmethod
+    def composeTimed(dstFile, srcFile, dstSize, isOverlaid=True):
 
-        with open(tempFile, 'rb') as srcFp:
+        startTime = time.perf_counter()
 
-            with Image.open(srcFp) as image:
+        ImageKit.compose(dstFile, srcFile, dstSize, isOverlaid)
 
-                cover = resizeimage.resize_cover(image, dstSize)
-                cover.save(dstFile, image.format)
+        return time.perf_counter() - startTime
+
+    @staticmethod
+    def record(future):
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        with ImageKit._mutex:
+
+            ImageKit._stats['count'] += 1
+            ImageKit._stats['time'] += future.result()
+
+    @staticmethod
+    def trace(future, dstSize):
+
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        Tracer.add('compose', 'image', future.result(), size=dstSize, worker=True)
+
+    @staticmethod
+    def getStats():
+
+        with ImageKit._mutex:
+            return dict(ImageKit._stats, workers=ImageKit.workers)
+
+    @staticmethod
+    def report():
+
+        stats = ImageKit.getStats()
+
+        if 0 == stats['count']:
+            return
+
+        if stats['workers'] > 0:
+            workers = 'on {} processes'.format(stats['workers'])
+        else:
+            workers = 'in the calling threads'
+
+        print('images: {} frames, {:.2f}s composing {}'.format(stats['count'], stats['time'], workers))
 
     @staticmethod
     def stretch(dstFile, srcFile, dstSize, resolution=300):
  
-        with WandImage(filename=srcFile, resolution=resolution) as srcImg:
+        with Tracer.span('stretch', 'image', size=dstSize):
 
-            with WandImage(width=srcImg.width, height=srcImg.height, background=Color('white')) as dstImg:
+            with WandImage(filename=srcFile, resolution=resolution) as srcImg:
 
-                dstImg.composite(srcImg, 0, 0)
-                dstImg.resize(dstSize[0], dstSize[1])
-                dstImg.save(filename=dstFile)
+                with WandImage(width=srcImg.width, height=srcImg.height, background=Color('white')) as dstImg:
 
+                    dstImg.composite(srcImg, 0, 0)
+                    dstImg.resize(dstSize[0], dstSize[1])
+                    dstImg.save(filename=dstFile)
 
     @staticmethod
-    def blurdim(dstFile, srcFile):
+    def load(srcFile, dstSize):
+
+        with Image.open(srcFile) as image:
+
+            # JPEG is downscaled while it's decoded, to no less than the size it's drawn at
+            if 'JPEG' == image.format:
+
+                scale = max(float(dstSize[0]) / image.width, float(dstSize[1]) / image.height)
+                image.draft('RGB', (int(image.width * scale) + 1, int(image.height * scale) + 1))
+
+            # The first frame of GIF, and transparent areas are white
+            if 'RGBA' == image.mode or 'LA' == image.mode or 'transparency' in image.info:
+
+                foreground = image.convert('RGBA')
+
+                background = Image.new('RGB', foreground.size, 'white')
+                background.paste(foreground, mask=foreground.split()[3])
+
+                return background
+
+            return image.convert('RGB')
+
+    @staticmethod
+    def compose(dstFile, srcFile, dstSize, isOverlaid=True, radius=8, brightness=0.5):
+
+        # Background is the image covering the size, blurred and dimmed, and the whole image is
+        # overlaid at its center. Only the final frame is written
+        with Tracer.span('compose', 'image', size=dstSize):
+
+            image = ImageKit.load(srcFile, dstSize)
+
+            frame = ImageOps.fit(image, dstSize, Image.BICUBIC)
+            frame = frame.filter(ImageFilter.GaussianBlur(radius)).point(lambda p: p * brightness)
 
-        with open(srcFile, 'rb') as srcFp:
+            if isOverlaid:
 
-            with Image.open(srcFp) as srcImage:
+                if image.width * dstSize[1] > image.height * dstSize[0]:
+                    size = (dstSize[0], max(1, int(round(image.height * dstSize[0] / float(image.width)))))
+                else:
+                    size = (max(1, int(round(image.width * dstSize[1] / float(image.height)))), dstSize[1])
 
-                blurredImage = srcImage.filter(ImageFilter.GaussianBlur(8))
-                dimImage = blurredImage.point(lambda p: p * 0.5)
+                if size != image.size:
+                    image = image.resize(size, Image.BICUBIC)
 
-                dimImage.save(dstFile, srcImage.format)
+                frame.paste(image, ((dstSize[0] - size[0]) // 2, (dstSize[1] - size[1]) // 2))
 
+            frame.save(dstFile, 'JPEG', quality=90)
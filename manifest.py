@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+class BuildManifest:
+
+    def __init__(self, path):
+
+        self.path = path
+        self.pathname = os.path.join(path, 'manifest.json')
+
+        try:
+            with open(self.pathname) as fp:
+                self.stages = json.loads(fp.read())
+        except (IOError, ValueError):
+            self.stages = dict()
+
+        self.mutex = threading.Lock()
+
+    @staticmethod
+    def fingerprint(*values):
+
+        m = hashlib.md5()
+        m.update(json.dumps(values, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8'))
+
+        return m.hexdigest()
+
+    @staticmethod
+    def fileFingerprint(pathname):
+
+        if not pathname or not os.path.exists(pathname):
+            return None
+
+        m = hashlib.md5()
+
+        with open(pathname, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+                m.update(chunk)
+
+        return m.hexdigest()
+
+    def getFingerprint(self, stage):
+
+        with self.mutex:
+            record = self.stages.get(stage)
+
+        if record is None:
+            return None
+
+        return record['fingerprint']
+
+    def getValue(self, stage, name, defaultValue=None):
+
+        with self.mutex:
+            record = self.stages.get(stage)
+
+        if record is None:
+            return defaultValue
+
+        return record['values'].get(name, defaultValue)
+
+    def isFresh(self, stage, fingerprint, outputs=None):
+
+        if fingerprint != self.getFingerprint(stage):
+            return False
+
+        for output in outputs or list():
+            if not output or not os.path.exists(output):
+                return False
+
+        return True
+
+    def invalidate(self, stage):
+
+        with self.mutex:
+
+            if self.stages.pop(stage, None) is None:
+                return
+
+            self.save()
+
+    def update(self, stage, fingerprint, **values):
+
+        with self.mutex:
+
+            self.stages[stage] = {'fingerprint': fingerprint, 'values': values}
+            self.save()
+
+    def run(self, stage, fingerprint, outputs, function, *args):
+
+        if self.isFresh(stage, fingerprint, outputs):
+            print('Skip', stage, 'in', self.path)
+            return False
+
+        # A stage interrupted halfway must not be taken as done
+        self.invalidate(stage)
+
+        function(*args)
+
+        self.update(stage, fingerprint)
+
+        return True
+
+    def save(self):
+
+        fd, tempPath = tempfile.mkstemp(dir=self.path)
+
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(json.dumps(self.stages, ensure_ascii=False, indent=4, sort_keys=True))
+
+        os.replace(tempPath, self.pathname)
+
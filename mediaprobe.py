@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import json
+import os
+import threading
+
+from context import JobContext
+from runner import CommandRunner
+
+class MediaInfo:
+
+    def __init__(self, data):
+
+        format = data.get('format', dict())
+
+        self.formatName = format.get('format_name')
+        self.duration = float(format.get('duration') or 0.0)
+
+        self.videoCodec = None
+        self.width = 0
+        self.height = 0
+        self.pixelFormat = None
+        self.timeBase = None
+
+        self.audioCodec = None
+        self.sampleRate = 0
+        self.channels = 0
+
+        for stream in data.get('streams', list()):
+
+            codecType = stream.get('codec_type')
+
+            if 'video' == codecType and self.videoCodec is None:
+
+                self.videoCodec = stream.get('codec_name')
+                self.width = int(stream.get('width') or 0)
+                self.height = int(stream.get('height') or 0)
+                self.pixelFormat = stream.get('pix_fmt')
+                self.timeBase = stream.get('time_base')
+
+            elif 'audio' == codecType and self.audioCodec is None:
+
+                self.audioCodec = stream.get('codec_name')
+                self.sampleRate = int(stream.get('sample_rate') or 0)
+                self.channels = int(stream.get('channels') or 0)
+
+        # Some containers only have durations in streams
+        if self.duration <= 0.0:
+
+            for stream in data.get('streams', list()):
+                self.duration = max(self.duration, float(stream.get('duration') or 0.0))
+
+    def getConcatSignature(self):
+
+        # What stream copy needs to be the same, frame rates differ as stories have variable ones
+        return (self.videoCodec, self.width, self.height, self.pixelFormat, self.timeBase,
+                self.audioCodec, self.sampleRate, self.channels)
+
+class MediaProbe:
+
+    workers = 8
+
+    _cache = dict()
+    _mutex = threading.Lock()
+
+    @staticmethod
+    def getFingerprint(pathname):
+
+        st = os.stat(pathname)
+        return (os.path.realpath(pathname), st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def probe(pathname):
+
+        # Only container and stream headers are read, the payload isn't decoded
+        try:
+            fingerprint = MediaProbe.getFingerprint(pathname)
+        except FileNotFoundError:
+            return None
+
+        with MediaProbe._mutex:
+            info = MediaProbe._cache.get(fingerprint)
+
+        if info is not None:
+            return info
+
+        cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', pathname]
+
+        try:
+            output = CommandRunner.run(cmd, captureStdout=True).stdout
+            info = MediaInfo(json.loads(output.decode('utf-8', 'ignore')))
+        except Exception as e:
+            print('Unable to probe', pathname, ':', e)
+            return None
+
+        with MediaProbe._mutex:
+            MediaProbe._cache[fingerprint] = info
+
+        return info
+
+    @staticmethod
+    def probeMany(pathnames):
+
+        if len(pathnames) < 2:
+            return [MediaProbe.probe(pathname) for pathname in pathnames]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MediaProbe.workers) as executor:
+            return list(executor.map(JobContext.wrap(MediaProbe.probe), pathnames))
+
+    @staticmethod
+    def getDuration(pathname):
+
+        info = MediaProbe.probe(pathname)
+
+        if info is None:
+            return 0.0
+
+        return info.duration
+
+    @staticmethod
+    def isConcatCompatible(pathnames):
+
+        signatures = set()
+
+        for info in MediaProbe.probeMany(pathnames):
+
+            if info is None:
+                return False
+
+            signatures.add(info.getConcatSignature())
+
+        return len(signatures) <= 1
+
@@ -1,15 +1,54 @@
+import concurrent.futures
+import hashlib
+import json
 import os
 import random
 import requests
+import threading
 import time
+import urllib.parse
 
-from utils import chmod
+from cache import FileCache
+from context import JobContext
+from tracer import Tracer
+from utils import chmod, getProperty, OutputPath
 
 class Network:
 
     _instance = None
     timeout = 10
 
+    workers = 8
+    connectionsPerHost = 2
+
+    _mutex = threading.Lock()
+    cache = None
+
+    _pid = None
+    _executor = None
+    _hostSemaphores = dict()
+
+    @staticmethod
+    def init(configFile):
+
+        workers = getProperty(configFile, 'download-workers')
+        if workers:
+            Network.workers = int(workers)
+
+        connectionsPerHost = getProperty(configFile, 'download-connections-per-host')
+        if connectionsPerHost:
+            Network.connectionsPerHost = int(connectionsPerHost)
+
+        # Downloads are cached by url across days and revalidated with conditional requests
+        cachePath = OutputPath.getCachePath('urls')
+
+        if cachePath is not None:
+
+            cacheSize = getProperty(configFile, 'url-cache-size') # In MB
+            cacheSize = int(cacheSize) if cacheSize else 1024
+
+            Network.cache = FileCache(cachePath, cacheSize * 1024 * 1024)
+
     def __init__(self):
         self.isEnabled = True
 
@@ -29,7 +68,16 @@ class Network:
 
         for i in range(retries):
             try:
-                return requests.get(url, params=params, timeout=Network.timeout, **kwargs)
+                with Network.getHostSemaphore(url):
+                    with Tracer.span('GET', 'http', url=url) as span:
+
+                        r = requests.get(url, params=params, timeout=Network.timeout, **kwargs)
+
+                        span.set('status', r.status_code)
+                        span.set('bytes', len(r.content))
+
+                        return r
+
             except Exception as e:
                 print('Error to get', url, ':', e)
 
@@ -77,12 +125,12 @@ class Network:
         return r.text
 
     @staticmethod
-    def saveUrl(pathPrefix, url, retries=1):
+    def saveUrl(pathPrefix, url, retries=1, useCache=True):
 
         if Network._instance is None:
             Network._instance = Network()
 
-        path = Network._instance.saveUrlImpl(pathPrefix, url, retries)
+        path = Network._instance.saveUrlImpl(pathPrefix, url, retries, useCache)
 
         # Sleep for a while
         if path is not None:
@@ -90,26 +138,156 @@ class Network:
 
         return path 
 
-    def saveUrlImpl(self, pathPrefix, url, retries):
+    @staticmethod
+    def submitUrls(items, retries=1):
+
+        # items: list of (pathPrefix, url), returns futures of paths in the same order
+        if Network._instance is None:
+            Network._instance = Network()
+
+        executor = Network.getExecutor()
+
+        return [executor.submit(JobContext.wrap(Network._instance.saveUrlImpl), pathPrefix, url, retries)
+                for pathPrefix, url in items]
+
+    @staticmethod
+    def saveUrls(items, retries=1):
+
+        # items: list of (pathPrefix, url), returns paths in the same order
+        futures = Network.submitUrls(items, retries)
+
+        paths = list()
+
+        for future in futures:
+            try:
+                paths.append(future.result())
+            except Exception as e:
+                print('Error to save', ':', e)
+                paths.append(None)
+
+        return paths
+
+    @staticmethod
+    def getExecutor():
+
+        with Network._mutex:
+
+            Network.checkProcess()
+
+            if Network._executor is None:
+                Network._executor = concurrent.futures.ThreadPoolExecutor(max_workers=Network.workers)
+
+            return Network._executor
+
+    @staticmethod
+    def getHostSemaphore(url):
+
+        host = urllib.parse.urlparse(url).netloc
+
+        with Network._mutex:
+
+            Network.checkProcess()
+
+            semaphore = Network._hostSemaphores.get(host)
+
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(Network.connectionsPerHost)
+                Network._hostSemaphores[host] = semaphore
+
+            return semaphore
 
-        r = Network.get(url, retries=retries)
+    @staticmethod
+    def checkProcess():
+
+        # A forked process doesn't inherit the threads of its parent
+        if Network._pid != os.getpid():
+
+            Network._pid = os.getpid()
+            Network._executor = None
+            Network._hostSemaphores = dict()
+
+    @staticmethod
+    def getPathname(pathPrefix, contentType):
+
+        if 'image/jpeg' == contentType:
+            return '{}.jpg'.format(pathPrefix)
+
+        if 'image/png' == contentType:
+            return '{}.png'.format(pathPrefix)
+
+        if 'image/gif' == contentType:
+            return '{}.gif'.format(pathPrefix)
+
+        if 'audio/mpeg' == contentType:
+            return '{}.mp3'.format(pathPrefix)
+
+        print('Not support', contentType)
+        return None
+
+    def saveUrlImpl(self, pathPrefix, url, retries, useCache=True):
+
+        with Tracer.span('save', 'http', url=url):
+            return self.saveUrlWithCache(pathPrefix, url, retries, useCache)
+
+    def saveUrlWithCache(self, pathPrefix, url, retries, useCache):
+
+        cache = Network.cache if useCache else None
+
+        if cache is not None:
+
+            key = hashlib.md5(url.encode('utf-8')).hexdigest()
+
+            meta = cache.read(key, '.json')
+            if meta is not None:
+                meta = json.loads(meta.decode('utf-8'))
+        else:
+            meta = None
+
+        headers = dict()
+
+        if meta is not None:
+
+            if meta.get('ETag'):
+                headers['If-None-Match'] = meta['ETag']
+
+            if meta.get('Last-Modified'):
+                headers['If-Modified-Since'] = meta['Last-Modified']
+
+        isMissCounted = False
+
+        r = Network.get(url, retries=retries, headers=headers)
         if r is None:
             return None
 
+        # Not modified, use the cached one
+        if 304 == r.status_code and meta is not None:
+
+            pathname = Network.getPathname(pathPrefix, meta['Content-Type'])
+            if pathname is None:
+                return None
+
+            if cache.get(key, pathname, '.body') is not None:
+
+                chmod(pathname)
+
+                print('Revalidated:', pathname)
+                Tracer.annotate(cache='revalidated')
+
+                return pathname
+
+            # The cached body has been evicted, and its miss is already counted by get
+            isMissCounted = True
+
+            r = Network.get(url, retries=retries)
+            if r is None:
+                return None
+
         # TODO: add other judgement for http response
 
-        contentType = r.headers['Content-Type']
+        contentType = r.headers.get('Content-Type')
 
-        if 'image/jpeg' == contentType:
-            pathname = '{}.jpg'.format(pathPrefix)
-        elif 'image/png' == contentType:
-            pathname = '{}.png'.format(pathPrefix)
-        elif 'image/gif' == contentType:
-            pathname = '{}.gif'.format(pathPrefix)
-        elif 'audio/mpeg' == contentType:
-            pathname = '{}.mp3'.format(pathPrefix)
-        else:
-            print('Not support', contentType)
+        pathname = Network.getPathname(pathPrefix, contentType)
+        if pathname is None:
             return None
 
         with open(pathname, 'wb') as fp:
@@ -118,6 +296,23 @@ class Network:
         chmod(pathname)
 
         print('Downloaded:', pathname)
+        Tracer.annotate(cache='miss' if cache is not None else 'none', bytes=len(r.content))
+
+        if cache is not None and not isMissCounted:
+            cache.countMiss()
+
+        if cache is not None and 200 == r.status_code:
+
+            meta = dict()
+
+            meta['Content-Type'] = contentType
+            meta['ETag'] = r.headers.get('ETag')
+            meta['Last-Modified'] = r.headers.get('Last-Modified')
+
+            if meta['ETag'] or meta['Last-Modified']:
+
+                cache.put(key, pathname, '.body')
+                cache.write(key, json.dumps(meta).encode('utf-8'), '.json')
 
         return pathname
 
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from context import JobContext
+from tracer import Tracer
+
+class CommandError(subprocess.CalledProcessError):
+
+    def __init__(self, returncode, cmd, output=None, stderr=None, reason=None):
+
+        subprocess.CalledProcessError.__init__(self, returncode, cmd, output, stderr)
+        self.reason = reason
+
+    def __str__(self):
+
+        if self.reason is not None:
+            message = 'Command \'{}\' {}'.format(' '.join(self.cmd), self.reason)
+        else:
+            message = subprocess.CalledProcessError.__str__(self).rstrip('.')
+
+        if self.stderr:
+            lines = self.stderr.decode('utf-8', 'ignore').strip().splitlines()
+            message = '{}:\n{}'.format(message, '\n'.join(lines[-5:]))
+
+        return message
+
+class CommandResult:
+
+    def __init__(self, argv, returncode, stdout, stderr, wallTime, cpuTime, maxRss):
+
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+        self.wallTime = wallTime # In seconds
+        self.cpuTime = cpuTime # User and system time in seconds
+        self.maxRss = maxRss # In KB
+
+class CommandRunner:
+
+    timeout = 3600 # In seconds, None for no limit
+    killTimeout = 5
+
+    maxStderrSize = 64 * 1024
+
+    _mutex = threading.Lock()
+    _stats = dict()
+
+    @staticmethod
+    def init(configFile):
+
+        from utils import getProperty
+
+        timeout = getProperty(configFile, 'command-timeout')
+        if timeout:
+            CommandRunner.timeout = int(timeout) if int(timeout) > 0 else None
+
+    @staticmethod
+    def run(argv, timeout=0, input=None, captureStdout=False, cancelEvent=None):
+
+        # timeout: 0 for the default one, None for no limit
+        # input: bytes, or an iterable of bytes which is written as it's produced
+        if 0 == timeout:
+            timeout = CommandRunner.timeout
+
+        # Commands of a cancelled job are killed
+        if cancelEvent is None:
+            cancelEvent = JobContext.get('cancelEvent')
+
+        argv = [str(arg) for arg in argv]
+
+        with Tracer.span(os.path.basename(argv[0]), 'command', argv=' '.join(argv)) as span:
+
+            result = CommandRunner.runImpl(argv, timeout, input, captureStdout, cancelEvent)
+
+            span.set('cpuTime', result.cpuTime)
+            span.set('maxRss', result.maxRss)
+            span.set('stdoutBytes', len(result.stdout))
+
+        return result
+
+    @staticmethod
+    def runImpl(argv, timeout, input, captureStdout, cancelEvent):
+
+        if cancelEvent is not None and cancelEvent.is_set():
+            raise CommandError(None, argv, reason='was cancelled before it started')
+
+        startTime = time.time()
+
+        # The command runs in its own process group, so it can be killed with its children
+        process = subprocess.Popen(argv, start_new_session=True,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE if captureStdout else subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+
+        stdoutChunks = list()
+        stderrBuffer = bytearray()
+
+        def readStdout():
+
+            for chunk in iter(lambda: process.stdout.read(65536), b''):
+                stdoutChunks.append(chunk)
+
+        def readStderr():
+
+            # Only the tail of output is kept
+            for chunk in iter(lambda: process.stderr.read1(65536), b''):
+
+                stderrBuffer.extend(chunk)
+
+                if len(stderrBuffer) > CommandRunner.maxStderrSize:
+                    del stderrBuffer[:len(stderrBuffer) - CommandRunner.maxStderrSize]
+
+        inputErrors = list()
+
+        def writeStdin():
+
+            try:
+                if isinstance(input, (bytes, bytearray, memoryview)):
+                    process.stdin.write(input)
+                else:
+                    for chunk in input:
+                        process.stdin.write(chunk)
+
+            except BrokenPipeError:
+                pass
+            except Exception as e:
+                inputErrors.append(e)
+
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        status = dict()
+        finished = threading.Event()
+
+        def wait():
+
+            pid, status['status'], status['rusage'] = os.wait4(process.pid, 0)
+            finished.set()
+
+        threads = [threading.Thread(target=readStderr), threading.Thread(target=wait)]
+
+        if captureStdout:
+            threads.append(threading.Thread(target=readStdout))
+
+        if input is not None:
+            threads.append(threading.Thread(target=writeStdin))
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        reason = None
+
+        try:
+            while not finished.wait(0.1):
+
+                if timeout is not None and time.time() - startTime > timeout:
+                    reason = 'timed out after {} seconds'.format(timeout)
+                elif cancelEvent is not None and cancelEvent.is_set():
+                    reason = 'was cancelled'
+                else:
+                    continue
+
+                CommandRunner.kill(process, finished)
+                break
+
+        except BaseException:
+            CommandRunner.kill(process, finished)
+            raise
+
+        finished.wait()
+
+        for thread in threads:
+            thread.join()
+
+        # wait4 has reaped the process
+        process.returncode = os.waitstatus_to_exitcode(status['status'])
+
+        for fp in [process.stdin, process.stdout, process.stderr]:
+            if fp is not None:
+                try:
+                    fp.close()
+                except BrokenPipeError:
+                    pass
+
+        rusage = status['rusage']
+
+        result = CommandResult(argv, process.returncode, b''.join(stdoutChunks),
+                bytes(stderrBuffer), time.time() - startTime,
+                rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss)
+
+        CommandRunner.record(result)
+
+        if len(inputErrors) > 0:
+            raise inputErrors[0]
+
+        if reason is not None:
+            raise CommandError(process.returncode, argv, result.stdout, result.stderr, reason)
+
+        if process.returncode != 0:
+            raise CommandError(process.returncode, argv, result.stdout, result.stderr)
+
+        return result
+
+    @staticmethod
+    def kill(process, finished):
+
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+
+            if not finished.wait(CommandRunner.killTimeout):
+                os.killpg(process.pid, signal.SIGKILL)
+
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def record(result):
+
+        name = os.path.basename(result.argv[0])
+
+        with CommandRunner._mutex:
+
+            stat = CommandRunner._stats.get(name)
+
+            if stat is None:
+                stat = {'count': 0, 'wallTime': 0.0, 'cpuTime': 0.0, 'maxRss': 0}
+                CommandRunner._stats[name] = stat
+
+            stat['count'] += 1
+            stat['wallTime'] += result.wallTime
+            stat['cpuTime'] += result.cpuTime
+            stat['maxRss'] = max(stat['maxRss'], result.maxRss)
+
+    @staticmethod
+    def getStats():
+
+        with CommandRunner._mutex:
+            return {name: dict(stat) for name, stat in CommandRunner._stats.items()}
+
+    @staticmethod
+    def report():
+
+        for name, stat in sorted(CommandRunner.getStats().items()):
+            print('{}: {} commands, {:.2f}s wall, {:.2f}s cpu, {} KB peak rss'.format(name,
+                stat['count'], stat['wallTime'], stat['cpuTime'], stat['maxRss']))
+
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import os
+import threading
+import time
+import traceback
+
+from context import JobContext
+
+class DependencyError(Exception):
+    pass
+
+class CancelledError(Exception):
+    pass
+
+class Task:
+
+    # Resource classes
+    NETWORK = 'network' # Waits for remote hosts, takes no cores
+    LIGHT = 'light' # Takes one core
+    HEAVY = 'heavy' # Encodes, takes a share of the core budget
+
+    def __init__(self, name, function, dependencies=None, resource=LIGHT, callback=None):
+
+        self.name = name
+        self.function = function
+        self.dependencies = list(dependencies or list())
+        self.resource = resource
+
+        # Called with the task once it's done, failed or skipped
+        self.callback = callback
+
+        self.threads = None
+        self.result = None
+        self.error = None
+
+        self.isDone = False
+
+    def run(self):
+
+        startTime = time.time()
+
+        if Task.NETWORK == self.resource:
+            print('Start', self.name)
+        else:
+            print('Start', self.name, 'with', self.threads, 'threads')
+
+        self.result = self.function(self.threads)
+
+        print('Finish', self.name, 'in {:.2f} seconds'.format(time.time() - startTime))
+
+        return self.result
+
+class Scheduler:
+
+    def __init__(self, jobs=1, cpus=None):
+
+        self.jobs = max(1, jobs)
+        self.cpus = max(1, cpus or os.cpu_count() or 1)
+
+        self.tasks = list()
+
+        self.usedCores = 0
+        self.mutex = threading.Lock()
+
+    def addTask(self, name, function, dependencies=None, resource=Task.LIGHT, callback=None):
+
+        task = Task(name, function, dependencies, resource, callback)
+        self.tasks.append(task)
+
+        return task
+
+    def allocate(self, task, readyTasks, runningTasks):
+
+        freeCores = self.cpus - self.usedCores
+
+        if Task.NETWORK == task.resource:
+            return 0
+
+        # Never block when nothing else runs
+        if freeCores <= 0:
+            if len(runningTasks) > 0:
+                return None
+            freeCores = 1
+
+        if Task.LIGHT == task.resource:
+            return 1
+
+        # Share the cores among heavy tasks which are running or ready
+        heavyCount = len([t for t in set(readyTasks) | set(runningTasks) if Task.HEAVY == t.resource])
+        share = max(1, self.cpus // max(1, heavyCount))
+
+        return min(share, freeCores)
+
+    def finish(self, task):
+
+        task.isDone = True
+
+        if task.callback is not None:
+            try:
+                task.callback(task)
+            except Exception as e:
+                print('Error occurs in the callback of', task.name, ':', e)
+
+    def run(self):
+
+        pending = list(self.tasks)
+        running = dict()
+
+        cancelEvent = JobContext.get('cancelEvent')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+
+            while len(pending) > 0 or len(running) > 0:
+
+                # Tasks are started in the order they were added
+                readyTasks = list()
+
+                for task in list(pending):
+
+                    # Tasks of a cancelled job are never started
+                    if cancelEvent is not None and cancelEvent.is_set():
+
+                        task.error = CancelledError('{} is cancelled'.format(task.name))
+                        self.finish(task)
+
+                        pending.remove(task)
+                        continue
+
+                    failedTasks = [dependency for dependency in task.dependencies
+                            if dependency.isDone and dependency.error is not None]
+
+                    if len(failedTasks) > 0:
+
+                        task.error = DependencyError('{} failed'.format(failedTasks[0].name))
+                        self.finish(task)
+
+                        pending.remove(task)
+                        continue
+
+                    if all(dependency.isDone for dependency in task.dependencies):
+                        readyTasks.append(task)
+
+                for task in readyTasks:
+
+                    if len(running) >= self.jobs:
+                        break
+
+                    cores = self.allocate(task, readyTasks, list(running.values()))
+
+                    if cores is None:
+                        continue
+
+                    if Task.NETWORK != task.resource:
+                        task.threads = cores
+
+                    with self.mutex:
+                        self.usedCores += cores
+
+                    pending.remove(task)
+                    running[executor.submit(JobContext.wrap(task.run))] = task
+
+                if len(running) == 0:
+
+                    if len(pending) > 0:
+                        raise DependencyError('{} never gets ready'.format(pending[0].name))
+
+                    continue
+
+                done, notDone = concurrent.futures.wait(running.keys(),
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+
+                    task = running.pop(future)
+
+                    with self.mutex:
+                        self.usedCores -= task.threads or 0
+
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print('Error occurs in', task.name, ':', e)
+                        traceback.print_exc()
+
+                        task.error = e
+
+                    self.finish(task)
+
+        # The same as a serial run, the first error is raised
+        for task in self.tasks:
+            if task.error is not None and not isinstance(task.error, DependencyError):
+                raise task.error
+
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import argparse
+import heapq
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+
+from combiner import Combiner
+from context import JobContext
+from datetime import datetime
+from imgkit import ImageKit
+from network import Network
+from runner import CommandRunner
+from tts import Tts
+from urlutils import JsonResult
+from utils import mkdir, OutputPath
+
+class JobLog:
+
+    # Output of a job goes to its log, including the threads it starts, and other output to the console
+    def __init__(self, stream):
+
+        self.stream = stream
+        self.mutex = threading.Lock()
+
+    def write(self, content):
+
+        fp = JobContext.get('log')
+
+        if fp is None:
+            return self.stream.write(content)
+
+        with self.mutex:
+            return fp.write(content)
+
+    def flush(self):
+
+        fp = JobContext.get('log')
+
+        if fp is None:
+            self.stream.flush()
+        else:
+            fp.flush()
+
+class RenderJob:
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, jobId, path, priority=0, profileName=None, jobs=1):
+
+        self.id = jobId
+        self.path = path
+
+        self.contentFile = os.path.join(path, 'content.json')
+        self.videoFile = os.path.join(path, 'video.mp4')
+        self.logFile = os.path.join(path, 'log.txt')
+        self.dataPath = os.path.join(path, 'datas')
+
+        self.priority = priority
+        self.profileName = profileName
+        self.jobs = jobs
+
+        self.status = RenderJob.QUEUED
+        self.error = None
+
+        self.createdTime = time.time()
+        self.startTime = None
+        self.endTime = None
+
+        self.cancelEvent = threading.Event()
+
+    def toDict(self):
+
+        def toTime(seconds):
+
+            if seconds is None:
+                return None
+
+            return datetime.fromtimestamp(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+        return {'id': self.id, 'status': self.status, 'error': self.error, 'priority': self.priority,
+                'profile': self.profileName, 'jobs': self.jobs, 'video': self.videoFile, 'log': self.logFile,
+                'created': toTime(self.createdTime), 'started': toTime(self.startTime),
+                'finished': toTime(self.endTime)}
+
+class RenderService:
+
+    def __init__(self, configFile, ttsConfigFile, jobsPath, workers=1, withLogo=True, cpus=None):
+
+        self.configFile = configFile
+        self.ttsConfigFile = ttsConfigFile
+        self.jobsPath = jobsPath
+
+        self.workers = max(1, workers)
+        self.withLogo = withLogo
+
+        # Encoders of all workers share the cores
+        self.cpus = max(1, (cpus or os.cpu_count() or 1) // self.workers)
+
+        self.jobs = dict()
+
+        # Higher priorities first, then in the order of submission
+        self.queue = list()
+        self.sequence = 0
+
+        self.condition = threading.Condition()
+        self.isRunning = True
+
+        self.threads = list()
+
+    def start(self):
+
+        for index in range(self.workers):
+
+            thread = threading.Thread(target=self.work, name='worker-{}'.format(index))
+            thread.daemon = True
+            thread.start()
+
+            self.threads.append(thread)
+
+    def stop(self):
+
+        with self.condition:
+
+            self.isRunning = False
+
+            for job in self.jobs.values():
+                job.cancelEvent.set()
+
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, contentConfig, priority=0, profileName=None, jobs=1):
+
+        if not isinstance(contentConfig, dict) or not isinstance(contentConfig.get('contents-list'), list):
+            raise ValueError('No contents-list in content')
+
+        jobId = uuid.uuid4().hex[:12]
+        job = RenderJob(jobId, os.path.join(self.jobsPath, jobId), priority, profileName, max(1, jobs))
+
+        mkdir(job.path)
+        mkdir(job.dataPath)
+
+        with open(job.contentFile, 'w') as fp:
+            fp.write(json.dumps(contentConfig, ensure_ascii=False, indent=4))
+
+        with self.condition:
+
+            self.jobs[job.id] = job
+
+            heapq.heappush(self.queue, (-job.priority, self.sequence, job.id))
+            self.sequence += 1
+
+            self.condition.notify()
+
+        print('Job', job.id, 'is queued with priority', job.priority)
+
+        return job
+
+    def getJob(self, jobId):
+
+        with self.condition:
+            return self.jobs.get(jobId)
+
+    def getJobs(self):
+
+        with self.condition:
+            return sorted(self.jobs.values(), key=lambda job: job.createdTime)
+
+    def cancel(self, jobId):
+
+        with self.condition:
+
+            job = self.jobs.get(jobId)
+
+            if job is None:
+                return None
+
+            # A queued job is dropped when it's popped, a running one is stopped at its next command
+            if RenderJob.QUEUED == job.status:
+                job.status = RenderJob.CANCELLED
+                job.endTime = time.time()
+
+            job.cancelEvent.set()
+
+        print('Job', jobId, 'is cancelled')
+
+        return job
+
+    def work(self):
+
+        # Every worker has its own voices, caches on disk are shared
+        tts = Tts(self.ttsConfigFile)
+
+        while True:
+
+            with self.condition:
+
+                while self.isRunning and 0 == len(self.queue):
+                    self.condition.wait()
+
+                if not self.isRunning:
+                    return
+
+                priority, sequence, jobId = heapq.heappop(self.queue)
+                job = self.jobs[jobId]
+
+                if RenderJob.QUEUED != job.status:
+                    continue
+
+                job.status = RenderJob.RUNNING
+                job.startTime = time.time()
+
+            print('Job', job.id, 'is started by', threading.current_thread().name)
+
+            status, error = self.render(job, tts)
+
+            with self.condition:
+
+                job.status = status
+                job.error = error
+                job.endTime = time.time()
+
+            print('Job', job.id, 'is', status, 'in {:.2f} seconds'.format(job.endTime - job.startTime))
+
+    def render(self, job, tts):
+
+        with open(job.logFile, 'a', buffering=1) as fp:
+
+            JobContext.setValues({'cancelEvent': job.cancelEvent, 'log': fp, 'dataPath': job.dataPath})
+
+            try:
+                print('Now: ', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+
+                combiner = Combiner(self.configFile, self.withLogo, job.profileName)
+                combiner.combine(tts, job.contentFile, job.videoFile, job.jobs, self.cpus)
+
+                if job.cancelEvent.is_set():
+                    return RenderJob.CANCELLED, None
+
+                if combiner.videoPath is None:
+                    return RenderJob.FAILED, 'No video is rendered'
+
+                return RenderJob.DONE, None
+
+            except Exception as e:
+                print('Error occurs at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                traceback.print_exc(file=sys.stdout)
+
+                if job.cancelEvent.is_set():
+                    return RenderJob.CANCELLED, None
+
+                return RenderJob.FAILED, str(e) or type(e).__name__
+
+            finally:
+                JobContext.setValues(dict())
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+
+    service = None
+
+    MAX_CONTENT_SIZE = 16 * 1024 * 1024
+
+    def log_message(self, format, *args):
+        print('{} - {}'.format(self.address_string(), format % args))
+
+    def sendResult(self, result, status=200):
+
+        content = json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+
+        self.wfile.write(content)
+
+    def sendError(self, status, message):
+        self.sendResult(JsonResult.error(status, message), status)
+
+    def parsePath(self):
+
+        url = urllib.parse.urlparse(self.path)
+
+        names = [name for name in url.path.split('/') if name]
+        params = dict(urllib.parse.parse_qsl(url.query))
+
+        return names, params
+
+    def getJob(self, jobId):
+
+        job = ServiceHandler.service.getJob(jobId)
+
+        if job is None:
+            self.sendError(404, 'No job {}'.format(jobId))
+
+        return job
+
+    def do_GET(self):
+
+        names, params = self.parsePath()
+
+        # GET /jobs
+        if ['jobs'] == names:
+            return self.sendResult(JsonResult.succeed([job.toDict() for job in ServiceHandler.service.getJobs()]))
+
+        # GET /jobs/<id>
+        if 2 == len(names) and 'jobs' == names[0]:
+
+            job = self.getJob(names[1])
+
+            if job is not None:
+                self.sendResult(JsonResult.succeed(job.toDict()))
+
+            return
+
+        # GET /jobs/<id>/log
+        if 3 == len(names) and 'jobs' == names[0] and 'log' == names[2]:
+
+            job = self.getJob(names[1])
+
+            if job is None:
+                return
+
+            try:
+                with open(job.logFile, 'rb') as fp:
+                    content = fp.read()
+            except FileNotFoundError:
+                content = b''
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+
+            self.wfile.write(content)
+
+            return
+
+        self.sendError(404, 'No such path {}'.format(self.path))
+
+    def do_POST(self):
+
+        names, params = self.parsePath()
+
+        # POST /jobs?priority=N&profile=draft&jobs=N with content.json as the body
+        if ['jobs'] == names:
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+
+                if length <= 0 or length > ServiceHandler.MAX_CONTENT_SIZE:
+                    raise ValueError('Content-Length should be 1 to {}'.format(ServiceHandler.MAX_CONTENT_SIZE))
+
+                contentConfig = json.loads(self.rfile.read(length).decode('utf-8'))
+
+                profileName = params.get('profile') or None
+
+                if profileName is not None and profileName not in ['draft', 'preview', 'final']:
+                    raise ValueError('Not support profile {}'.format(profileName))
+
+                job = ServiceHandler.service.submit(contentConfig, int(params.get('priority', 0)),
+                        profileName, int(params.get('jobs', 1)))
+
+            except ValueError as e:
+                return self.sendError(400, str(e))
+
+            return self.sendResult(JsonResult.succeed(job.toDict()))
+
+        # POST /jobs/<id>/cancel
+        if 3 == len(names) and 'jobs' == names[0] and 'cancel' == names[2]:
+
+            job = ServiceHandler.service.cancel(names[1])
+
+            if job is None:
+                return self.sendError(404, 'No job {}'.format(names[1]))
+
+            return self.sendResult(JsonResult.succeed(job.toDict()))
+
+        self.sendError(404, 'No such path {}'.format(self.path))
+
+def run(configFile, ttsConfigFile, jobsPath, host='127.0.0.1', port=8130, workers=1, withLogo=True, cpus=None):
+
+    OutputPath.init(configFile)
+
+    Network.init(configFile)
+    CommandRunner.init(configFile)
+    ImageKit.init(configFile, cpus)
+    Network.setIsEnabled(True)
+
+    # Output of every job goes to its own log
+    sys.stdout = JobLog(sys.stdout)
+
+    service = RenderService(configFile, ttsConfigFile, jobsPath, workers, withLogo, cpus)
+    service.start()
+
+    ServiceHandler.service = service
+
+    server = http.server.ThreadingHTTPServer((host, port), ServiceHandler)
+
+    print('Serve on http://{}:{}/ with {} workers, jobs in {}'.format(host, server.server_port,
+        service.workers, jobsPath))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('configFile', metavar='config-file')
+    parser.add_argument('ttsConfigFile', metavar='tts-config-file')
+    parser.add_argument('-o', '--output', dest='jobsPath', required=True, metavar='DIR',
+            help='directory of jobs, with their content, video and log')
+    parser.add_argument('--host', default='127.0.0.1',
+            help='address to listen on, 127.0.0.1 by default')
+    parser.add_argument('--port', type=int, default=8130,
+            help='port to listen on, 8130 by default')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+            help='number of jobs rendered at the same time')
+    parser.add_argument('--cpus', type=int, default=None,
+            help='number of cores shared by encoders of all workers, all cores by default')
+    parser.add_argument('--no-logo', dest='withLogo', action='store_false',
+            help='don\'t add logo to videos')
+
+    args = parser.parse_args()
+
+    os.environ['TZ'] = 'Asia/Shanghai'
+    time.tzset()
+
+    configFile = os.path.realpath(args.configFile)
+    ttsConfigFile = os.path.realpath(args.ttsConfigFile)
+
+    jobsPath = os.path.realpath(args.jobsPath)
+    os.makedirs(jobsPath, exist_ok=True)
+
+    run(configFile, ttsConfigFile, jobsPath, args.host, args.port, max(1, args.workers), args.withLogo, args.cpus)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import argparse
+import http.server
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+
+from service import RenderJob, RenderService, ServiceHandler
+
+class ServiceChecker:
+
+    # Checks the API of a render service on 127.0.0.1. No worker is started, so jobs stay queued
+    # and nothing is rendered
+    def __init__(self, jobsPath):
+
+        self.service = RenderService(None, None, jobsPath)
+        ServiceHandler.service = self.service
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ServiceHandler)
+        self.baseUrl = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+        self.failures = list()
+
+    def start(self):
+
+        thread = threading.Thread(target=self.server.serve_forever, name='server')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, method, path, body=None):
+
+        request = urllib.request.Request(self.baseUrl + path, data=body, method=method)
+
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+    def requestJson(self, method, path, body=None):
+
+        status, content = self.request(method, path, body)
+
+        try:
+            return status, json.loads(content.decode('utf-8'))
+        except ValueError:
+            return status, None
+
+    def check(self, name, isPassed):
+
+        print('{}: {}'.format('PASS' if isPassed else 'FAIL', name))
+
+        if not isPassed:
+            self.failures.append(name)
+
+    def checkError(self, name, method, path, status, body=None):
+
+        # Errors are JsonResult envelopes with the HTTP status as their code
+        result, envelope = self.requestJson(method, path, body)
+
+        self.check(name, status == result and envelope is not None and envelope['data'] is None
+                and status == envelope['error']['code'] and envelope['error']['message'])
+
+    def run(self):
+
+        content = json.dumps({'contents-list': list()}).encode('utf-8')
+
+        status, envelope = self.requestJson('POST', '/jobs?priority=2&profile=draft', content)
+        job = envelope['data'] if envelope is not None else None
+
+        self.check('POST /jobs queues a job', 200 == status and job is not None
+                and RenderJob.QUEUED == job['status'] and 2 == job['priority'] and 'draft' == job['profile'])
+
+        if job is None:
+            return False
+
+        path = '/jobs/{}'.format(job['id'])
+
+        status, envelope = self.requestJson('GET', path)
+        self.check('GET /jobs/<id> returns the job', 200 == status and 0 == envelope['error']['code']
+                and job['id'] == envelope['data']['id'] and RenderJob.QUEUED == envelope['data']['status'])
+
+        status, envelope = self.requestJson('GET', '/jobs')
+        self.check('GET /jobs lists the job', 200 == status and job['id'] in [j['id'] for j in envelope['data']])
+
+        status, content = self.request('GET', path + '/log')
+        self.check('GET /jobs/<id>/log returns the log', 200 == status and b'' == content)
+
+        status, envelope = self.requestJson('POST', path + '/cancel')
+        self.check('POST /jobs/<id>/cancel drops a queued job', 200 == status
+                and RenderJob.CANCELLED == envelope['data']['status'])
+
+        status, envelope = self.requestJson('GET', path)
+        self.check('a cancelled job stays cancelled', RenderJob.CANCELLED == envelope['data']['status'])
+
+        self.checkError('POST /jobs without a body is 400', 'POST', '/jobs', 400)
+        self.checkError('POST /jobs with invalid JSON is 400', 'POST', '/jobs', 400, b'{')
+        self.checkError('POST /jobs without contents-list is 400', 'POST', '/jobs', 400, b'{}')
+        self.checkError('POST /jobs with an unknown profile is 400', 'POST', '/jobs?profile=huge', 400, content)
+        self.checkError('GET of an unknown job is 404', 'GET', '/jobs/unknown', 404)
+        self.checkError('GET of the log of an unknown job is 404', 'GET', '/jobs/unknown/log', 404)
+        self.checkError('cancel of an unknown job is 404', 'POST', '/jobs/unknown/cancel', 404)
+        self.checkError('GET of an unknown path is 404', 'GET', '/unknown', 404)
+        self.checkError('POST to an unknown path is 404', 'POST', '/unknown', 404)
+
+        return 0 == len(self.failures)
+
+def run(jobsPath):
+
+    checker = ServiceChecker(jobsPath)
+    checker.start()
+
+    try:
+        isPassed = checker.run()
+    finally:
+        checker.stop()
+
+    if isPassed:
+        print('All checks passed')
+    else:
+        print('Failed:', ', '.join(checker.failures))
+
+    return isPassed
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the API of the render service on 127.0.0.1')
+
+    parser.add_argument('--work-dir', dest='jobsPath',
+            help='directory of jobs, a temporary one which is removed afterwards by default')
+
+    args = parser.parse_args()
+
+    jobsPath = args.jobsPath or tempfile.mkdtemp(prefix='servicecheck-')
+
+    try:
+        isPassed = run(jobsPath)
+    finally:
+        if not args.jobsPath:
+            shutil.rmtree(jobsPath, ignore_errors=True)
+
+    sys.exit(0 if isPassed else 1)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import os
+import re
+import threading
+
+from PIL import ImageFont
+from utils import duration2asstime
+
+class FontMetrics:
+
+    # Metrics are shared by all stories, keyed by font file and size
+    fonts = dict()
+    _mutex = threading.Lock()
+
+    # Every CJK character may start a line, other words are kept whole with their spaces
+    TOKEN_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]|'
+            r'[^\s\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+|\s+')
+
+    # Punctuation which shouldn't start a line
+    CLOSING = set('\uff0c\u3002\u3001\uff1b\uff1a\uff1f\uff01\uff09\u300b\u300d\u300f\u3011\u2026,.;:?!)%')
+
+    def __init__(self, fontPath, fontSize):
+
+        self.fontPath = fontPath
+        self.fontSize = fontSize
+
+        # libass sizes a font by its ascent and descent rather than its em square, measured large for precision
+        ascent, descent = FontMetrics.loadFont(fontPath, 1000).getmetrics()
+
+        self.font = FontMetrics.loadFont(fontPath, fontSize * 1000.0 / (ascent + descent)
+                if ascent + descent > 0 else fontSize)
+
+        self.family = self.font.getname()[0] if fontPath else 'Arial'
+
+        self.widths = dict()
+        self.mutex = threading.Lock()
+
+    @staticmethod
+    def loadFont(fontPath, fontSize):
+
+        if fontPath:
+            return ImageFont.truetype(fontPath, fontSize)
+
+        return ImageFont.load_default(fontSize)
+
+    @staticmethod
+    def get(fontPath, fontSize):
+
+        key = (fontPath or '', fontSize)
+
+        with FontMetrics._mutex:
+
+            metrics = FontMetrics.fonts.get(key)
+
+            if metrics is None:
+                metrics = FontMetrics(fontPath, fontSize)
+                FontMetrics.fonts[key] = metrics
+
+            return metrics
+
+    def measure(self, token):
+
+        with self.mutex:
+
+            width = self.widths.get(token)
+
+            if width is None:
+                width = self.font.getlength(token)
+                self.widths[token] = width
+
+            return width
+
+    def split(self, text):
+
+        tokens = list()
+
+        for token in FontMetrics.TOKEN_PATTERN.findall(text):
+
+            if tokens and token[0] in FontMetrics.CLOSING and not tokens[-1].isspace():
+                tokens[-1] += token
+            else:
+                tokens.append(token)
+
+        return tokens
+
+    def wrap(self, text, maxWidth):
+
+        lines = list()
+
+        line = ''
+        width = 0.0
+
+        isSpaced = False
+
+        for token in self.split(text):
+
+            if token.isspace():
+                isSpaced = len(line) > 0
+                continue
+
+            tokenWidth = self.measure(token)
+            spaceWidth = self.measure(' ') if isSpaced else 0.0
+
+            if line and width + spaceWidth + tokenWidth > maxWidth:
+
+                lines.append(line)
+
+                line = ''
+                width = 0.0
+
+            elif isSpaced:
+
+                line += ' '
+                width += spaceWidth
+
+            isSpaced = False
+
+            # A word longer than a line is broken by characters
+            if tokenWidth > maxWidth:
+
+                for char in token:
+
+                    charWidth = self.measure(char)
+
+                    if line and width + charWidth > maxWidth:
+
+                        lines.append(line)
+
+                        line = ''
+                        width = 0.0
+
+                    line += char
+                    width += charWidth
+
+                continue
+
+            line += token
+            width += tokenWidth
+
+        if line:
+            lines.append(line)
+
+        return lines
+
+class SubtitleWriter:
+
+    # Sizes are relative to a 720-pixel height, as the profile scales the frame
+    FONT_SIZE = 40
+    OUTLINE = 2
+    MARGIN = 32
+
+    def __init__(self, width, height, fontPath=None, fontSize=None):
+
+        self.width = width
+        self.height = height
+
+        scale = height / 720.0
+
+        self.fontSize = int(round(fontSize or SubtitleWriter.FONT_SIZE * scale))
+        self.outline = max(1, int(round(SubtitleWriter.OUTLINE * scale)))
+        self.margin = max(1, int(round(SubtitleWriter.MARGIN * scale)))
+
+        self.metrics = FontMetrics.get(fontPath, self.fontSize)
+
+    def getMaxWidth(self):
+        return self.width - 2 * (self.margin + self.outline)
+
+    @staticmethod
+    def escape(text):
+
+        # Braces start override tags and backslashes start escapes in ASS, a word joiner keeps one as it is
+        return text.replace('\\', '\\\u2060').replace('{', '\\{').replace('}', '\\}')
+
+    def write(self, assPath, cues):
+
+        maxWidth = self.getMaxWidth()
+
+        with open(assPath, 'w', encoding='utf-8') as fp:
+
+            fp.write('[Script Info]\n'
+                    'ScriptType: v4.00+\n'
+                    'PlayResX: {}\n'
+                    'PlayResY: {}\n'
+                    'WrapStyle: 2\n'
+                    'ScaledBorderAndShadow: yes\n'
+                    'YCbCr Matrix: None\n\n'.format(self.width, self.height))
+
+            # Lines are wrapped here, so libass only breaks at \N
+            fp.write('[V4+ Styles]\n'
+                    'Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, '
+                    'Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, '
+                    'Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n'
+                    'Style: Default,{},{},&H00FFFFFF,&H00FFFFFF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,{},0,2,'
+                    '{},{},{},1\n\n'.format(self.metrics.family, self.fontSize, self.outline,
+                        self.margin, self.margin, self.margin))
+
+            fp.write('[Events]\n'
+                    'Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n')
+
+            for start, end, text in cues:
+
+                lines = self.metrics.wrap(' '.join(text.split()), maxWidth)
+
+                fp.write('Dialogue: 0,{},{},Default,,0,0,0,,{}\n'.format(duration2asstime(start),
+                    duration2asstime(end), '\\N'.join(SubtitleWriter.escape(line) for line in lines)))
+
+    @staticmethod
+    def getFontsDir(fontPath):
+        return os.path.dirname(os.path.realpath(fontPath)) if fontPath else None
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+class Span:
+
+    def __init__(self, name, category, args):
+
+        self.name = name
+        self.category = category
+        self.args = args
+
+        self.profile = None
+        self.snapshot = None
+
+    def set(self, name, value):
+        self.args[name] = value
+
+    def __enter__(self):
+
+        Tracer.startHooks(self)
+        Tracer.push(self)
+
+        self.startTime = time.perf_counter()
+
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+
+        endTime = time.perf_counter()
+
+        if excValue is not None:
+            self.args['error'] = str(excValue) or excType.__name__
+
+        Tracer.pop(self)
+        Tracer.stopHooks(self)
+
+        Tracer.record(self, endTime)
+
+        return False
+
+class NullSpan:
+
+    def set(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+class Tracer:
+
+    isEnabled = False
+
+    tracePath = None
+    profilePrefix = None
+
+    # Stages run under cProfile or tracemalloc
+    profileStages = set()
+    memoryStages = set()
+
+    _startTime = time.perf_counter()
+
+    _events = list()
+    _threadNames = dict()
+    _mutex = threading.Lock()
+
+    _local = threading.local()
+    _nullSpan = NullSpan()
+
+    _profileMutex = threading.Lock()
+    _profileCounts = dict()
+
+    @staticmethod
+    def init(tracePath=None, profileStages=None, memoryStages=None, profilePrefix=None):
+
+        Tracer.tracePath = tracePath
+        Tracer.profilePrefix = profilePrefix or tracePath
+
+        Tracer.profileStages = set(profileStages or list())
+        Tracer.memoryStages = set(memoryStages or list())
+
+        Tracer.isEnabled = bool(tracePath or Tracer.profileStages or Tracer.memoryStages)
+
+        if len(Tracer.memoryStages) > 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @staticmethod
+    def span(name, category='stage', **args):
+
+        # Nothing is recorded unless tracing is enabled
+        if not Tracer.isEnabled:
+            return Tracer._nullSpan
+
+        return Span(name, category, args)
+
+    @staticmethod
+    def add(name, category, duration, **args):
+
+        # A span which ended now, timed somewhere else like in another process
+        if not Tracer.isEnabled:
+            return
+
+        span = Span(name, category, args)
+
+        endTime = time.perf_counter()
+        span.startTime = endTime - duration
+
+        Tracer.record(span, endTime)
+
+    @staticmethod
+    def annotate(**args):
+
+        # Attributes of the innermost span in the current thread
+        spans = getattr(Tracer._local, 'spans', None)
+
+        if spans:
+            spans[-1].args.update(args)
+
+    @staticmethod
+    def push(span):
+
+        if not hasattr(Tracer._local, 'spans'):
+            Tracer._local.spans = list()
+
+        Tracer._local.spans.append(span)
+
+    @staticmethod
+    def pop(span):
+
+        spans = Tracer._local.spans
+
+        if spans and spans[-1] is span:
+            spans.pop()
+
+    @staticmethod
+    def record(span, endTime):
+
+        thread = threading.current_thread()
+
+        # Chrome trace events are in microseconds
+        event = {'name': span.name, 'cat': span.category, 'ph': 'X',
+                'ts': int((span.startTime - Tracer._startTime) * 1000000),
+                'dur': int((endTime - span.startTime) * 1000000),
+                'pid': os.getpid(), 'tid': thread.ident, 'args': span.args}
+
+        with Tracer._mutex:
+
+            Tracer._events.append(event)
+            Tracer._threadNames[(os.getpid(), thread.ident)] = thread.name
+
+    @staticmethod
+    def startHooks(span):
+
+        if 'stage' != span.category:
+            return
+
+        # Only one profiler can be active at a time
+        if span.name in Tracer.profileStages and Tracer._profileMutex.acquire(blocking=False):
+
+            span.profile = cProfile.Profile()
+            span.profile.enable()
+
+        if span.name in Tracer.memoryStages and tracemalloc.is_tracing():
+
+            span.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+
+    @staticmethod
+    def stopHooks(span):
+
+        if span.snapshot is not None:
+
+            # Allocations are traced for the whole process, including other threads
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+
+            stats = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]).compare_to(
+                    span.snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)]), 'lineno')
+
+            span.set('memoryDelta', sum(stat.size_diff for stat in stats))
+            span.set('memoryPeak', peak)
+
+            print('Memory of', span.name, ': peak', peak, 'bytes, top allocations:')
+
+            for stat in stats[:10]:
+                print(stat)
+
+        if span.profile is not None:
+
+            span.profile.disable()
+            Tracer._profileMutex.release()
+
+            with Tracer._mutex:
+                count = Tracer._profileCounts.get(span.name, 0)
+                Tracer._profileCounts[span.name] = count + 1
+
+            pathname = '{}.{}.{}.prof'.format(Tracer.profilePrefix or 'profile', span.name, count)
+            span.profile.dump_stats(pathname)
+
+            print('Profile of', span.name, 'is saved to', pathname)
+            span.set('profile', pathname)
+
+    @staticmethod
+    def getEvents():
+
+        with Tracer._mutex:
+            return list(Tracer._events)
+
+    @staticmethod
+    def save(pathname=None):
+
+        pathname = pathname or Tracer.tracePath
+
+        if not pathname:
+            return
+
+        with Tracer._mutex:
+
+            events = list(Tracer._events)
+
+            for (pid, tid), name in Tracer._threadNames.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                    'args': {'name': name}})
+
+        with open(pathname, 'w') as fp:
+            fp.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}, default=str))
+
+        print('Trace of', len(events), 'events is saved to', pathname)
+
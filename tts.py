@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import urllib.parse
+
+from cache import FileCache
+from context import JobContext
+from network import Network
+from runner import CommandRunner
+from utils import OutputPath
+
+class TtsEngine:
+
+    def __init__(self, config, concurrency):
+
+        self.config = config
+        self.concurrency = concurrency
+
+    def getLanguages(self):
+        return self.config['languages']
+
+    def getSuffix(self):
+        raise NotImplementedError()
+
+    def getChecksum(self, text, language, voiceIndex):
+        raise NotImplementedError()
+
+    def synthesizeMany(self, items, language, voiceIndex):
+
+        # items: list of (prefix, text), returns paths in the same order, None for failures
+        raise NotImplementedError()
+
+class OddcastEngine(TtsEngine):
+
+    def getSuffix(self):
+        return '.{}'.format(self.config['preparation']['EXT'])
+
+    def createUrls(self, text, language, voiceIndex):
+
+        url = self.config['url']
+
+        accountId = self.config['accountId']
+        secretId = self.config['secretId']
+
+        # Build parameters for each call, the shared configuration stays untouched
+        preparation = dict(self.config['preparation'])
+        download = dict(self.config['download'])
+
+        languageId = language['languageId']
+        voiceId = language['voiceIds'][voiceIndex]
+
+        m = hashlib.md5()
+
+        m.update(preparation['EID'].encode('utf-8'))
+        m.update(languageId.encode('utf-8'))
+        m.update(voiceId.encode('utf-8'))
+        m.update(text.encode('utf-8'))
+        m.update(preparation['IS_UTF8'].encode('utf-8'))
+        m.update(preparation['EXT'].encode('utf-8'))
+        m.update(accountId.encode('utf-8'))
+        m.update(secretId.encode('utf-8'))
+
+        cs = m.hexdigest()
+
+        preparation['LID'] = languageId
+        preparation['VID'] = voiceId
+        preparation['ACC'] = accountId
+        preparation['TXT'] = text
+        preparation['CS'] = cs
+
+        download['LID'] = languageId
+        download['VID'] = voiceId
+        download['ACC'] = accountId
+        download['TXT'] = text
+        download['CS'] = cs
+
+        preparationUrl = '{}{}'.format(url, urllib.parse.urlencode(preparation))
+        downloadUrl = '{}{}'.format(url, urllib.parse.urlencode(download))
+
+        return preparationUrl, downloadUrl, cs
+
+    def getChecksum(self, text, language, voiceIndex):
+        return self.createUrls(text, language, voiceIndex)[2]
+
+    def synthesize(self, prefix, text, language, voiceIndex):
+
+        preparationUrl, downloadUrl, cs = self.createUrls(text, language, voiceIndex)
+
+        Network.get(preparationUrl)
+
+        # Synthesized audio is cached by checksum instead of url
+        return Network.saveUrl(prefix, downloadUrl, useCache=False)
+
+    def synthesizeMany(self, items, language, voiceIndex):
+
+        if len(items) < 2 or self.concurrency < 2:
+            return [self.synthesize(prefix, text, language, voiceIndex) for prefix, text in items]
+
+        def download(preparationFuture, prefix, downloadUrl):
+
+            preparationFuture.result()
+
+            return Network.saveUrl(prefix, downloadUrl, useCache=False)
+
+        paths = [None] * len(items)
+        urls = [self.createUrls(text, language, voiceIndex) for prefix, text in items]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            # Preparations are queued first, so they run ahead of downloads
+            preparationFutures = [executor.submit(JobContext.wrap(Network.get), preparationUrl)
+                    for preparationUrl, downloadUrl, cs in urls]
+
+            downloadFutures = [executor.submit(JobContext.wrap(download), preparationFuture, prefix, downloadUrl)
+                    for preparationFuture, (prefix, text), (preparationUrl, downloadUrl, cs)
+                    in zip(preparationFutures, items, urls)]
+
+            for position, future in enumerate(downloadFutures):
+                try:
+                    paths[position] = future.result()
+                except Exception as e:
+                    print('Error to generate tts', ':', e)
+
+        return paths
+
+class EspeakEngine(TtsEngine):
+
+    # Synthesizes on this host, without any network round trip
+    def getSuffix(self):
+        return '.wav'
+
+    def getCommand(self, pathname, voiceId):
+
+        cmd = [self.config.get('command', 'espeak-ng'), '-v', voiceId, '-b', '1', '-w', pathname]
+
+        speed = self.config.get('speed')
+        if speed:
+            cmd += ['-s', speed]
+
+        return cmd + ['--stdin']
+
+    def getChecksum(self, text, language, voiceIndex):
+
+        m = hashlib.md5()
+
+        for value in self.getCommand('', language['voiceIds'][voiceIndex]) + [text]:
+            m.update(value.encode('utf-8'))
+            m.update(b'\0')
+
+        return m.hexdigest()
+
+    def synthesize(self, prefix, text, language, voiceIndex):
+
+        pathname = '{}{}'.format(prefix, self.getSuffix())
+
+        try:
+            CommandRunner.run(self.getCommand(pathname, language['voiceIds'][voiceIndex]),
+                    input=text.encode('utf-8'))
+        except Exception as e:
+            print('Error to generate tts', ':', e)
+            return None
+
+        return pathname
+
+    def synthesizeMany(self, items, language, voiceIndex):
+
+        if len(items) < 2 or self.concurrency < 2:
+            return [self.synthesize(prefix, text, language, voiceIndex) for prefix, text in items]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+
+            futures = [executor.submit(JobContext.wrap(self.synthesize), prefix, text, language, voiceIndex)
+                    for prefix, text in items]
+
+            return [future.result() for future in futures]
+
+class Tts:
+
+    ENGINES = {'oddcast': OddcastEngine, 'espeak': EspeakEngine}
+
+    def __init__(self, pathname):
+
+        with open(pathname) as fp:
+            self.config = json.loads(fp.read())
+
+            self.maxLength = int(self.config['max-length'])
+            self.concurrency = int(self.config.get('concurrency', 4))
+
+        engine = self.config.get('engine', 'oddcast')
+
+        if engine not in Tts.ENGINES:
+            raise ValueError('Not support tts engine {}'.format(engine))
+
+        # Oddcast is configured at the top level, other engines in their own sections
+        if 'oddcast' == engine:
+            engineConfig = self.config
+        else:
+            engineConfig = self.config[engine]
+
+        self.engine = Tts.ENGINES[engine](engineConfig, self.concurrency)
+
+        # Synthesized audio is cached by its checksum across days and jobs
+        cachePath = OutputPath.getCachePath('tts')
+
+        if cachePath is not None:
+            cacheSize = int(self.config.get('cache-size', 1024)) # In MB
+            self.cache = FileCache(cachePath, cacheSize * 1024 * 1024)
+        else:
+            self.cache = None
+
+    def setLanguage(self, language):
+
+        for lang in self.engine.getLanguages():
+            if language.lower() == lang['name']:
+                self.language = lang
+                break
+        else:
+            print('Not support language', language)
+
+        self.voiceIndex = None
+
+    def switchVoice(self):
+
+        if self.voiceIndex is None:
+            self.voiceIndex = 0
+        else:
+            self.voiceIndex += 1
+
+            if self.voiceIndex >= len(self.language['voiceIds']):
+                self.voiceIndex = 0
+
+    def getSuffix(self):
+        return self.engine.getSuffix()
+
+    def getChecksum(self, text, voiceIndex=None):
+
+        if voiceIndex is None:
+            voiceIndex = self.voiceIndex
+
+        return self.engine.getChecksum(text, self.language, voiceIndex)
+
+    def getCachedTts(self, prefix, cs):
+
+        if self.cache is None:
+            return None
+
+        suffix = self.getSuffix()
+
+        return self.cache.get(cs, '{}{}'.format(prefix, suffix), suffix)
+
+    def putCachedTts(self, pathname, cs):
+
+        if self.cache is None or pathname is None:
+            return
+
+        self.cache.put(cs, pathname, os.path.splitext(pathname)[1])
+
+    def generateTts(self, prefix, text, voiceIndex=None):
+        return self.synthesizeMany([(prefix, text)], voiceIndex)[0]
+
+    def synthesizeMany(self, items, voiceIndex=None):
+
+        # items: list of (prefix, text), returns paths in the same order
+        if voiceIndex is None:
+            voiceIndex = self.voiceIndex
+
+        paths = [None] * len(items)
+        pending = list()
+
+        for position, (prefix, text) in enumerate(items):
+
+            cs = self.getChecksum(text, voiceIndex)
+
+            paths[position] = self.getCachedTts(prefix, cs)
+
+            if paths[position] is None:
+                pending.append((position, prefix, text, cs))
+
+        if 0 == len(pending):
+            return paths
+
+        # Only segments missing in the cache are synthesized, in one batch
+        generatedPaths = self.engine.synthesizeMany([(prefix, text) for position, prefix, text, cs in pending],
+                self.language, voiceIndex)
+
+        for (position, prefix, text, cs), pathname in zip(pending, generatedPaths):
+
+            paths[position] = pathname
+            self.putCachedTts(pathname, cs)
+
+        return paths
+
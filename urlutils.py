@@ -7,7 +7,7 @@ import re
 import requests
 
 from network import Network
-from urllib import unquote_plus as urlunquote
+from urllib.parse import unquote_plus as urlunquote
 from utils import getProperty
 
 class JsonResult:
@@ -18,6 +18,7 @@ import threading
 import time
 import traceback
 
+from context import JobContext
 from datetime import tzinfo, timedelta, datetime
 
 def seconds2Datetime(seconds):
@@ -45,6 +46,17 @@ def duration2srttime(duration):
     return '{:02d}:{:02d}:{:02d},{:03d}'.format(hours, minutes,
             seconds, milliseconds)
 
+def duration2asstime(duration):
+    # [hours]:[minutes]:[seconds].[centiseconds]
+
+    centiseconds = int(round(duration * 100))
+
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+
+    return '{:d}:{:02d}:{:02d}.{:02d}'.format(hours, minutes, seconds, centiseconds)
+
 def randomSleep(minS, maxS):
     time.sleep(random.uniform(minS, maxS))
 
@@ -113,15 +125,12 @@ def unhexlifyUtf8(src):
 
 def runCommand(cmd, shell=False):
 
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-
-    output, unused_err = process.communicate()
-    retcode = process.poll()
+    # Kept for shell command lines, new code should pass argument lists to CommandRunner
+    from runner import CommandRunner
 
-    if retcode is not 0:
-        raise subprocess.CalledProcessError(retcode, cmd)
+    result = CommandRunner.run(['/bin/sh', '-c', cmd], captureStdout=True)
 
-    return output
+    return result.stdout + result.stderr
 
 def displayImage(path):
 
@@ -350,6 +359,7 @@ class OutputPath:
 
     LOG_OUTPUT_PATH = None
     DATA_OUTPUT_PATH = None
+    CACHE_OUTPUT_PATH = None
 
     @staticmethod
     def init(configFile):
@@ -368,17 +378,49 @@ class OutputPath:
         OutputPath.DATA_OUTPUT_PATH = os.path.join(path, datetime.now().strftime('%Y_%m_%d'))
         mkdir(OutputPath.DATA_OUTPUT_PATH)
 
+        # Caches are shared by all days
+        cachePath = getProperty(configFile, 'cache-path')
+
+        if cachePath:
+            OutputPath.CACHE_OUTPUT_PATH = os.path.realpath(cachePath)
+        else:
+            OutputPath.CACHE_OUTPUT_PATH = os.path.join(outputPath, 'caches')
+
+        mkdir(OutputPath.CACHE_OUTPUT_PATH)
+
     @staticmethod
     def createDataPath(name):
 
         path = OutputPath.getDataPath(name)
         mkdir(path)
 
+    @staticmethod
+    def getDataRoot():
+
+        # A job may have its own data path, so jobs in the same process don't share files
+        return JobContext.get('dataPath') or OutputPath.DATA_OUTPUT_PATH
+
     @staticmethod
     def getDataPath(name):
 
         name = slugify(name)
-        return os.path.join(OutputPath.DATA_OUTPUT_PATH, name)
+        return os.path.join(OutputPath.getDataRoot(), name)
+
+    @staticmethod
+    def getCachePath(name):
+
+        if OutputPath.CACHE_OUTPUT_PATH is None:
+            return None
+
+        return os.path.join(OutputPath.CACHE_OUTPUT_PATH, name)
+
+    @staticmethod
+    def getPaths():
+        return (OutputPath.LOG_OUTPUT_PATH, OutputPath.DATA_OUTPUT_PATH, OutputPath.CACHE_OUTPUT_PATH)
+
+    @staticmethod
+    def setPaths(paths):
+        OutputPath.LOG_OUTPUT_PATH, OutputPath.DATA_OUTPUT_PATH, OutputPath.CACHE_OUTPUT_PATH = paths
 
 class ThreadWritableObject(threading.Thread):
 
@@ -1,7 +1,16 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
-from utils import runCommand
+import concurrent.futures
+import math
+import numpy
+import os
+import threading
+
+from context import JobContext
+from PIL import Image, ImageOps
+from runner import CommandRunner
+from tracer import Tracer
 
 class VideoMaker:
 
@@ -25,25 +34,482 @@ class VideoMaker:
 
         with open(configPath, 'w') as fp:
             for video in self.videoList:
-                fp.write('file \'{}\'\n'.format(video))
+                fp.write('file {}\n'.format(VideoKit.quoteConcatPath(video)))
 
         print('Merge all to', dstVideoPath, 'from', configPath)
 
-        cmd = 'ffmpeg -y -f concat -safe 0 -i {} -c copy {}'.format(configPath, dstVideoPath)
+        CommandRunner.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', configPath, '-c', 'copy', dstVideoPath])
+
+class EncoderProfile:
+
+    # Settings shared by every encode of a run, final ones are the defaults of ffmpeg
+    # still-fps: frame rate of slides before titles and subtitles are added, gop: seconds between keyframes
+    PROFILES = {
+        'draft': {'scale': 0.5, 'preset': 'ultrafast', 'crf': 30, 'fps': 12, 'still-fps': 2, 'gop': 10,
+            'audio-bitrate': '48k'},
+        'preview': {'scale': 0.75, 'preset': 'veryfast', 'crf': 26, 'fps': 25, 'still-fps': 5, 'gop': 10,
+            'audio-bitrate': '64k'},
+        'final': {'scale': 1.0, 'preset': 'medium', 'crf': 23, 'fps': 25, 'still-fps': 5, 'gop': 10,
+            'audio-bitrate': '64k'},
+    }
+
+    # The same timescale for all videos, so they can be concatenated by copying streams
+    TIMESCALE = 90000
+
+    def __init__(self, name='final'):
+
+        if name not in EncoderProfile.PROFILES:
+            raise ValueError('Not support profile {}'.format(name))
+
+        settings = EncoderProfile.PROFILES[name]
+
+        self.name = name
+
+        self.scale = settings['scale']
+        self.preset = settings['preset']
+        self.crf = settings['crf']
+        self.fps = settings['fps']
+        self.stillFps = settings['still-fps']
+        self.gop = settings['gop']
+        self.audioBitrate = settings['audio-bitrate']
+
+    def scaleSize(self, width, height):
+
+        # x264 needs even sizes for yuv420p
+        return (int(width * self.scale) // 2 * 2, int(height * self.scale) // 2 * 2)
+
+    def scaleValue(self, value):
+        return max(1, int(round(value * self.scale)))
+
+    def getVideoArgs(self, threads=None, isStill=False):
+
+        args = ['-c:v', 'libx264', '-preset', self.preset, '-crf', self.crf, '-pix_fmt', 'yuv420p',
+                '-video_track_timescale', EncoderProfile.TIMESCALE]
+
+        # Keyframes are placed by time as frame rates are low or variable, so HLS segments never
+        # run longer than gop seconds
+        args += ['-force_key_frames', 'expr:gte(t,n_forced*{})'.format(self.gop)]
+
+        # Slides barely change
+        if isStill:
+            args += ['-tune', 'stillimage']
+
+        if threads:
+            args += ['-threads', threads]
+
+        return args
+
+    def getDecimateFilter(self):
+
+        # Frames identical to the last one are dropped, but at least one is kept every second
+        return 'mpdecimate=max={}'.format(self.fps - 1)
+
+    def getFingerprint(self):
+        return [self.name, self.scale, self.preset, self.crf, self.fps, self.stillFps, self.gop,
+                self.audioBitrate, EncoderProfile.TIMESCALE]
+
+class HlsWriter:
+
+    # Appends videos to an HLS playlist of fMP4 segments in order, as soon as they are done
+    def __init__(self, playlistPath, separatorPath=None, segmentTime=6, keyframeInterval=None):
+
+        self.playlistPath = playlistPath
+        self.path = os.path.dirname(os.path.realpath(playlistPath))
+        self.name = os.path.splitext(os.path.basename(playlistPath))[0]
+
+        self.separatorPath = separatorPath
+        self.separator = None
+        self.segmentTime = segmentTime
+
+        # Segments are cut at the first keyframe after segmentTime, and the target duration
+        # must stay the same for the whole playlist
+        self.entries = list()
+        self.targetDuration = int(math.ceil(max(segmentTime, keyframeInterval or 0)))
+        self.videoCount = 0
+
+        self.completedPaths = dict()
+        self.nextIndex = 0
+
+        self.mutex = threading.Lock()
+        self.futures = list()
+
+        # Videos are segmented one by one, in the order of the playlist
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.writePlaylist(False)
+
+    def complete(self, index, videoPath):
+
+        # index: position of the video, videoPath: None if it failed
+        with self.mutex:
+
+            self.completedPaths[index] = videoPath
+
+            while self.nextIndex in self.completedPaths:
+
+                videoPath = self.completedPaths.pop(self.nextIndex)
+                self.nextIndex += 1
+
+                if videoPath is not None:
+                    self.futures.append(self.executor.submit(JobContext.wrap(self.appendVideo), videoPath))
+
+    def close(self):
+
+        self.executor.shutdown(wait=True)
+
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as e:
+                print('Error to append to', self.playlistPath, ':', e)
+
+        self.writePlaylist(True)
+
+    def appendVideo(self, videoPath):
+
+        with Tracer.span('hls', 'stage', video=videoPath):
+
+            entries = self.segment(videoPath, '{}-{:03d}'.format(self.name, self.videoCount))
+            self.videoCount += 1
+
+            if 0 == len(self.entries):
+                entries = entries[1:] # No discontinuity before the first one
+
+            # Separators follow every video as in the concatenated one
+            if self.separatorPath is not None:
+
+                if self.separator is None:
+                    self.separator = self.segment(self.separatorPath, '{}-separator'.format(self.name))
+
+                entries += self.separator + self.separator
+
+            self.entries += entries
+
+            self.writePlaylist(False)
+
+        print('Append', videoPath, 'to', self.playlistPath)
+
+    def segment(self, videoPath, name):
+
+        playlistPath = os.path.join(self.path, '{}.m3u8'.format(name))
+
+        CommandRunner.run(['ffmpeg', '-y', '-i', videoPath, '-c', 'copy', '-f', 'hls',
+            '-hls_time', self.segmentTime, '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', '{}-init.mp4'.format(name),
+            '-hls_segment_filename', os.path.join(self.path, '{}-%03d.m4s'.format(name)), playlistPath])
+
+        # Every video starts with its own initialization section
+        entries = ['#EXT-X-DISCONTINUITY']
+
+        with open(playlistPath) as fp:
+
+            for line in fp:
+
+                line = line.strip()
+
+                if line.startswith('#EXT-X-MAP:') or line.startswith('#EXTINF:'):
+                    entries.append(line)
+                elif line and not line.startswith('#'):
+                    entries.append(line)
+
+        os.remove(playlistPath)
+
+        return entries
+
+    def writePlaylist(self, isEnded):
+
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-TARGETDURATION:{}'.format(self.targetDuration),
+                '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:EVENT']
+
+        lines += self.entries
+
+        if isEnded:
+            lines.append('#EXT-X-ENDLIST')
+
+        # Players never read a half-written playlist
+        tempPath = '{}.tmp'.format(self.playlistPath)
+
+        with open(tempPath, 'w') as fp:
+            fp.write('\n'.join(lines))
+            fp.write('\n')
+
+        os.replace(tempPath, self.playlistPath)
+
+class MotionRenderer:
+
+    # Seconds of a crossfade between two images
+    FADE = 1.0
+
+    # Zoom of the end of a motion, and where the view starts and ends from 0 (left or top) to 1
+    ZOOM = 1.15
+    MOTIONS = [
+        (True, (0.5, 0.5), (0.5, 0.5)),
+        (False, (0.0, 0.5), (1.0, 0.5)),
+        (True, (1.0, 0.0), (0.0, 1.0)),
+        (False, (0.5, 1.0), (0.5, 0.0)),
+    ]
+
+    def __init__(self, width, height):
+
+        self.width = width
+        self.height = height
+
+        # All buffers are allocated once, pixels are blended in 8 bits fixed point
+        shape = (height, width, 3)
+
+        self.sources = [numpy.zeros(shape, numpy.uint16) for index in range(2)]
+        self.sourceIndexes = [None, None]
+
+        self.upperRows = numpy.empty(shape, numpy.uint16)
+        self.lowerRows = numpy.empty(shape, numpy.uint16)
+        self.rightColumns = numpy.empty(shape, numpy.uint16)
+
+        self.frames = [numpy.empty(shape, numpy.uint16) for index in range(2)]
+        self.output = numpy.empty(shape, numpy.uint8)
+        self.outputData = memoryview(self.output).cast('B')
+
+        self.rowPositions = numpy.arange(height, dtype=numpy.float64)
+        self.columnPositions = numpy.arange(width, dtype=numpy.float64)
+
+        self.rowCoordinates = numpy.empty(height, numpy.float64)
+        self.columnCoordinates = numpy.empty(width, numpy.float64)
+
+        self.rowIndexes = numpy.empty(height, numpy.intp)
+        self.nextRowIndexes = numpy.empty(height, numpy.intp)
+        self.columnIndexes = numpy.empty(width, numpy.intp)
+        self.nextColumnIndexes = numpy.empty(width, numpy.intp)
+
+        self.rowWeights = numpy.empty((height, 1, 1), numpy.uint16)
+        self.rowInverseWeights = numpy.empty((height, 1, 1), numpy.uint16)
+        self.columnWeights = numpy.empty((1, width, 1), numpy.uint16)
+        self.columnInverseWeights = numpy.empty((1, width, 1), numpy.uint16)
 
-        runCommand(cmd)
+    def load(self, slot, index, imagePath):
+
+        if self.sourceIndexes[slot] == index:
+            return
+
+        with Image.open(imagePath) as image:
+
+            image = image.convert('RGB')
+
+            if image.size != (self.width, self.height):
+                image = ImageOps.fit(image, (self.width, self.height), Image.BICUBIC)
+
+            numpy.copyto(self.sources[slot], numpy.asarray(image), casting='unsafe')
+
+        self.sourceIndexes[slot] = index
+
+    def getCoordinates(self, positions, start, step, coordinates, indexes, nextIndexes, weights, inverseWeights):
+
+        # Position of every output pixel in the source, split to a pixel and the weight of the next one
+        numpy.multiply(positions, step, out=coordinates)
+        numpy.add(coordinates, start, out=coordinates)
+
+        numpy.copyto(indexes, coordinates, casting='unsafe')
+        numpy.minimum(indexes, len(positions) - 2, out=indexes)
+        numpy.add(indexes, 1, out=nextIndexes)
+
+        numpy.subtract(coordinates, indexes, out=coordinates)
+        numpy.clip(coordinates, 0.0, 1.0, out=coordinates)
+        numpy.multiply(coordinates, 256, out=coordinates)
+
+        numpy.copyto(weights.reshape(-1), coordinates, casting='unsafe')
+        numpy.subtract(256, weights, out=inverseWeights)
+
+    def render(self, slot, progress, frame):
+
+        # progress: 0 to 1 through the motion of the image in the slot
+        zoomIn, start, end = MotionRenderer.MOTIONS[self.sourceIndexes[slot] % len(MotionRenderer.MOTIONS)]
+
+        if zoomIn:
+            zoom = 1.0 + (MotionRenderer.ZOOM - 1.0) * progress
+        else:
+            zoom = MotionRenderer.ZOOM - (MotionRenderer.ZOOM - 1.0) * progress
+
+        x = start[0] + (end[0] - start[0]) * progress
+        y = start[1] + (end[1] - start[1]) * progress
+
+        viewWidth = self.width / zoom
+        viewHeight = self.height / zoom
+
+        self.getCoordinates(self.rowPositions, (self.height - viewHeight) * y, viewHeight / self.height,
+                self.rowCoordinates, self.rowIndexes, self.nextRowIndexes, self.rowWeights, self.rowInverseWeights)
+        self.getCoordinates(self.columnPositions, (self.width - viewWidth) * x, viewWidth / self.width,
+                self.columnCoordinates, self.columnIndexes, self.nextColumnIndexes, self.columnWeights,
+                self.columnInverseWeights)
+
+        source = self.sources[slot]
+
+        # Bilinear, rows first and then columns
+        numpy.take(source, self.rowIndexes, axis=0, mode='clip', out=self.upperRows)
+        numpy.take(source, self.nextRowIndexes, axis=0, mode='clip', out=self.lowerRows)
+
+        numpy.multiply(self.upperRows, self.rowInverseWeights, out=self.upperRows)
+        numpy.multiply(self.lowerRows, self.rowWeights, out=self.lowerRows)
+        numpy.add(self.upperRows, self.lowerRows, out=self.upperRows)
+        numpy.right_shift(self.upperRows, 8, out=self.upperRows)
+
+        numpy.take(self.upperRows, self.columnIndexes, axis=1, mode='clip', out=frame)
+        numpy.take(self.upperRows, self.nextColumnIndexes, axis=1, mode='clip', out=self.rightColumns)
+
+        numpy.multiply(frame, self.columnInverseWeights, out=frame)
+        numpy.multiply(self.rightColumns, self.columnWeights, out=self.rightColumns)
+        numpy.add(frame, self.rightColumns, out=frame)
+        numpy.right_shift(frame, 8, out=frame)
+
+    def generate(self, imagePaths, durations, fps):
+
+        # Images are shown one after another, and every one fades into the next one around their boundary
+        fade = min([MotionRenderer.FADE] + [duration / 2.0 for duration in durations])
+
+        starts = [sum(durations[:index]) for index in range(len(durations))]
+        length = sum(durations)
+
+        frameCount = int(round(length * fps))
+        index = 0
+
+        def getProgress(index, seconds):
+
+            # Motion runs through the image and both of its fades
+            return min(1.0, max(0.0, (seconds - starts[index] + fade / 2.0) / (durations[index] + fade)))
+
+        for frameIndex in range(frameCount):
+
+            seconds = float(frameIndex) / fps
+
+            while index + 1 < len(durations) and seconds >= starts[index + 1]:
+                index += 1
+
+            slot = index % 2
+
+            self.load(slot, index, imagePaths[index])
+            self.render(slot, getProgress(index, seconds), self.frames[0])
+
+            # The other image of a fade
+            other = None
+
+            if index + 1 < len(durations) and seconds > starts[index + 1] - fade / 2.0:
+                other = index + 1
+                alpha = (seconds - (starts[index + 1] - fade / 2.0)) / fade
+            elif index > 0 and seconds < starts[index] + fade / 2.0:
+                other = index - 1
+                alpha = (starts[index] + fade / 2.0 - seconds) / fade
+
+            if other is not None:
+
+                otherSlot = other % 2
+
+                self.load(otherSlot, other, imagePaths[other])
+                self.render(otherSlot, getProgress(other, seconds), self.frames[1])
+
+                weight = int(round(alpha * 256))
+
+                numpy.multiply(self.frames[0], 256 - weight, out=self.frames[0])
+                numpy.multiply(self.frames[1], weight, out=self.frames[1])
+                numpy.add(self.frames[0], self.frames[1], out=self.frames[0])
+                numpy.right_shift(self.frames[0], 8, out=self.frames[0])
+
+            numpy.copyto(self.output, self.frames[0], casting='unsafe')
+
+            # The same buffer is written again after it's sent
+            yield self.outputData
 
 class VideoKit:
 
     @staticmethod
-    def createLoopVideo(dstVideoPath, srcImagePath, videoLength):
+    def quoteConcatPath(pathname):
+
+        # Quoted for lists of the concat demuxer
+        return '\'{}\''.format(pathname.replace('\'', '\'\\\'\''))
+
+    @staticmethod
+    def escapeFilterValue(value):
+
+        # Escaped for an option value, then for the filtergraph it's put in
+        for char in '\\\':':
+            value = value.replace(char, '\\' + char)
+
+        for char in '\\\',;[]':
+            value = value.replace(char, '\\' + char)
+
+        return value
+
+    @staticmethod
+    def createLoopVideo(dstVideoPath, srcImagePath, videoLength, profile=None, threads=None, fps=None):
+
+        if profile is None:
+            profile = EncoderProfile()
+
+        # Slides are at the still frame rate by default
+        if fps is None:
+            fps = profile.stillFps
 
         print('Create video to', dstVideoPath, 'from', srcImagePath, 'with length', videoLength)
 
-        cmd = 'ffmpeg -y -loop 1 -i {} -c:v libx264 -t {:.2f} -pix_fmt yuv420p {}'.format(srcImagePath,
-                videoLength, dstVideoPath)
+        CommandRunner.run(['ffmpeg', '-y', '-loop', '1', '-framerate', fps, '-i', srcImagePath,
+            '-t', '{:.2f}'.format(videoLength)] + profile.getVideoArgs(threads, True) + [dstVideoPath])
+
+        return dstVideoPath
+
+    @staticmethod
+    def createSlideshow(dstVideoPath, srcImagePaths, durations, profile=None, threads=None):
+
+        if len(srcImagePaths) == 0:
+            return None
+
+        if profile is None:
+            profile = EncoderProfile()
+
+        # All images are encoded at once through the concat demuxer
+        configPath = '{}.txt'.format(dstVideoPath)
+
+        with open(configPath, 'w') as fp:
+
+            fp.write('ffconcat version 1.0\n')
+
+            for imagePath, duration in zip(srcImagePaths, durations):
+                fp.write('file {}\n'.format(VideoKit.quoteConcatPath(imagePath)))
+                fp.write('duration {:.3f}\n'.format(duration))
+
+            # The duration of the last image only applies if it's followed by another one
+            fp.write('file {}\n'.format(VideoKit.quoteConcatPath(srcImagePaths[-1])))
+
+        videoLength = sum(durations)
+
+        print('Create slideshow to', dstVideoPath, 'from', len(srcImagePaths), 'images with length', videoLength)
+
+        CommandRunner.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', configPath,
+            '-vf', 'fps={}'.format(profile.stillFps), '-t', '{:.3f}'.format(videoLength)]
+            + profile.getVideoArgs(threads, True) + [dstVideoPath])
+
+        return dstVideoPath
+
+    @staticmethod
+    def createMotionSlideshow(dstVideoPath, srcImagePaths, durations, profile=None, threads=None):
+
+        if len(srcImagePaths) == 0:
+            return None
+
+        if profile is None:
+            profile = EncoderProfile()
 
-        runCommand(cmd)
+        with Image.open(srcImagePaths[0]) as image:
+            width, height = image.size
+
+        videoLength = sum(durations)
+
+        print('Create motion slideshow to', dstVideoPath, 'from', len(srcImagePaths), 'images with length', videoLength)
+
+        # Frames are computed here and piped to one encoder, without any file between them
+        renderer = MotionRenderer(width, height)
+
+        CommandRunner.run(['ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+            '-framerate', profile.fps, '-i', '-', '-t', '{:.3f}'.format(videoLength)]
+            + profile.getVideoArgs(threads) + [dstVideoPath],
+            input=renderer.generate(srcImagePaths, durations, profile.fps))
 
         return dstVideoPath
 
@@ -60,8 +526,6 @@ class VideoKit:
 
         print('Merge', srcVideoPath, 'and', srcAudioPath, 'to', dstVideoPath)
 
-        cmd = 'ffmpeg -y -i {} -i {} -c copy -map \'0:v:0\' -map \'1:a:0\' {}'.format(srcVideoPath,
-                srcAudioPath, dstVideoPath)
-
-        runCommand(cmd)
+        CommandRunner.run(['ffmpeg', '-y', '-i', srcVideoPath, '-i', srcAudioPath, '-c', 'copy',
+            '-map', '0:v:0', '-map', '1:a:0', dstVideoPath])
 